@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Ingest benchmark for dotfiles.scripts.fsindex.
+
+Builds a synthetic tree (reused across runs when --tree is given) and reports
+files/sec for a first scan with several batch sizes, plus an incremental
+rescan of the unchanged tree.
+
+    python benchmarks/bench_fsindex.py --files 1000000 --tree /tmp/fsindex-bench
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from dotfiles.scripts import fsindex
+
+FILES_PER_DIR = 1000
+DIRS_PER_LEVEL = 32
+
+
+def make_tree(root: Path, files: int):
+    marker = root / f'.complete-{files}'
+    if marker.exists():
+        return
+
+    for i in range(files):
+        d, f = divmod(i, FILES_PER_DIR)
+        directory = root / f'd{d // DIRS_PER_LEVEL:03d}' / f'd{d % DIRS_PER_LEVEL:03d}'
+        if f == 0:
+            directory.mkdir(parents=True, exist_ok=True)
+        (directory / f'f{f:04d}.dat').touch()
+
+    marker.touch()
+
+
+def run_scan(db_path: Path, root: Path, **kwargs) -> tuple[float, fsindex.ScanStats]:
+    con = fsindex.connect(db_path)
+    try:
+        lib = fsindex.find_library(con, 'bench', root)
+        fsindex.tune_for_ingest(con)
+        started = time.perf_counter()
+        stats = fsindex.scan_library(con, lib, root, **kwargs)
+        return time.perf_counter() - started, stats
+    finally:
+        con.close()
+
+
+def db_size(db_path: Path) -> int:
+    """Database size including the WAL, which holds recent commits until checkpointed."""
+    return sum(
+        path.stat().st_size
+        for path in (db_path, db_path.with_name(db_path.name + '-wal'))
+        if path.exists()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1_000_000)
+    parser.add_argument('--tree', type=Path, help='where to build the synthetic tree')
+    parser.add_argument(
+        '--batch-sizes', type=int, nargs='+', default=[1, 100, 1000, 10000],
+        help='batch sizes to compare; 1 approximates one execute() per file',
+    )
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, fsindex.DEFAULT_JOBS])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='fsindex-bench-') as tmpdir:
+        root = args.tree or Path(tmpdir) / 'tree'
+        root.mkdir(parents=True, exist_ok=True)
+
+        started = time.perf_counter()
+        make_tree(root, args.files)
+        print(f'tree: {args.files} files in {root} ({time.perf_counter() - started:.1f}s)')
+
+        for batch_size in args.batch_sizes:
+            db_path = Path(tmpdir) / f'batch-{batch_size}.db'
+            elapsed, stats = run_scan(db_path, root, batch_size=batch_size)
+            print(f'first scan, batch {batch_size:>5}: {elapsed:7.1f}s '
+                  f'{stats.files_seen() / elapsed:9.0f} files/s '
+                  f'{db_size(db_path) / 2**20:7.1f} MiB')
+
+        for jobs in args.jobs:
+            db_path = Path(tmpdir) / f'jobs-{jobs}.db'
+            elapsed, stats = run_scan(db_path, root, jobs=jobs)
+            print(f'first scan, jobs  {jobs:>5}: {elapsed:7.1f}s '
+                  f'{stats.files_seen() / elapsed:9.0f} files/s')
+
+        elapsed, stats = run_scan(db_path, root)
+        print(f'incremental rescan:        {elapsed:7.1f}s '
+              f'({stats.dirs_skipped} dirs skipped, {stats.dirs_listed} listed)')
+
+        elapsed, stats = run_scan(db_path, root, full=True)
+        print(f'full rescan:               {elapsed:7.1f}s '
+              f'{stats.files_seen() / elapsed:9.0f} files/s')
+
+
+if __name__ == '__main__':
+    main()
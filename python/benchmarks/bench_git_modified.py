@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Status benchmark for dotfiles.scripts.git_modified.
+
+Clones a small origin into --repos checkouts (reused across runs when --tree
+is given) and compares `git status` against the fast path that reads .git
+directly and against `git for-each-ref` (--sync-only), both serially and
+with --jobs threads.
+
+    python benchmarks/bench_git_modified.py --repos 200 --files 2000 --tree /tmp/git-modified-bench
+"""
+
+import argparse
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from dotfiles.scripts import git_modified
+
+
+def git(repo: Path, *args):
+    subprocess.run(
+        ['git', '-c', 'user.name=Bench', '-c', 'user.email=bench@example.com', *args],
+        cwd=repo, check=True, capture_output=True,
+    )
+
+
+def make_repos(root: Path, repos: int, files: int) -> list[Path]:
+    checkouts = [root / f'repo{i:04d}' for i in range(repos)]
+    marker = root / f'.complete-{repos}-{files}'
+    if marker.exists():
+        return checkouts
+
+    origin = root / 'origin'
+    if not origin.exists():
+        origin.mkdir(parents=True)
+        git(origin, 'init', '-q', '-b', 'main')
+        for i in range(files):
+            d = origin / f'd{i // 100:03d}'
+            d.mkdir(exist_ok=True)
+            (d / f'f{i:05d}').write_text(str(i))
+        git(origin, 'add', '.')
+        git(origin, 'commit', '-q', '-m', 'initial')
+
+    for i, checkout in enumerate(checkouts):
+        if not checkout.exists():
+            git(root, 'clone', '-q', str(origin), checkout.name)
+            if i % 4 == 0:
+                git(checkout, 'commit', '-q', '--allow-empty', '-m', 'ahead')
+
+    marker.touch()
+    return checkouts
+
+
+RUNNERS = {
+    'git status': git_modified.run_status,
+    'fast path': git_modified.fast_status,
+    'sync only': git_modified.sync_status,
+}
+
+
+def run(repos: list[Path], jobs: int, runner) -> float:
+    parser = git_modified.PorcelainV2Parser()
+    started = time.perf_counter()
+    for status in git_modified.collect_statuses(repos, jobs=jobs, runner=runner):
+        if status.report is None:
+            parser.loads(status.stdout, status.repo)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--files', type=int, default=1000, help='files per checkout')
+    parser.add_argument('--jobs', type=int, default=8)
+    parser.add_argument('--tree', type=Path, help='where to keep the checkouts between runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.tree or Path(tmp)
+        repos = make_repos(root, args.repos, args.files)
+
+        # Warm the page cache and let git refresh the indexes once
+        run(repos, args.jobs, git_modified.run_status)
+
+        for jobs in (1, args.jobs):
+            for name, runner in RUNNERS.items():
+                elapsed = run(repos, jobs, runner)
+                print(f'{name:<10}  jobs={jobs:<3}  {elapsed:7.3f}s  {len(repos) / elapsed:8.0f} repos/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+# Kinds of repository, by how their git dir is laid out
+REPO = 'repo'            # a worktree with its own .git directory
+WORKTREE = 'worktree'    # a linked worktree (git worktree add), sharing another repo's objects
+SUBMODULE = 'submodule'  # a submodule whose git dir lives in the superproject
+BARE = 'bare'            # a git dir without a worktree
+
+
+@dataclass
+class GitDirs:
+    # None for bare repositories
+    worktree: Optional[Path]
+    # Per-worktree files: HEAD, index
+    git_dir: Path
+    # Shared by all worktrees: config, refs, packed-refs, objects
+    common_dir: Path
+    kind: str = REPO
+
+    @property
+    def path(self) -> Path:
+        return self.worktree if self.worktree is not None else self.git_dir
+
+
+def find_git_dirs(worktree: Path) -> Optional[GitDirs]:
+    """
+    Locate the git directories of a worktree, following the `.git` file of
+    linked worktrees and submodules. Returns None if there is no `.git`.
+    """
+    dotgit = worktree / '.git'
+    if dotgit.is_dir():
+        git_dir = dotgit
+        kind = REPO
+    elif dotgit.is_file():
+        content = dotgit.read_text().strip()
+        if not content.startswith('gitdir: '):
+            return None
+        git_dir = (worktree / content.removeprefix('gitdir: ')).resolve()
+        kind = SUBMODULE
+    else:
+        return None
+
+    commondir = git_dir / 'commondir'
+    if commondir.is_file():
+        common_dir = (git_dir / commondir.read_text().strip()).resolve()
+        kind = WORKTREE
+    else:
+        common_dir = git_dir
+
+    return GitDirs(worktree=worktree, git_dir=git_dir, common_dir=common_dir, kind=kind)
+
+
+def is_bare_git_dir(path: Path) -> bool:
+    return (path / 'HEAD').is_file() and (path / 'objects').is_dir() and (path / 'refs').is_dir()
+
+
+def classify_repo(path: Path) -> Optional[GitDirs]:
+    """Find the git dirs of `path`, be it a worktree or a bare repository. None if it's neither."""
+    dirs = find_git_dirs(path)
+    if dirs is None and is_bare_git_dir(path):
+        dirs = GitDirs(worktree=None, git_dir=path, common_dir=path, kind=BARE)
+    return dirs
+
+
+def read_head(dirs: GitDirs) -> Optional[str]:
+    """The ref HEAD points to (e.g. 'refs/heads/main'), or None if detached."""
+    head = (dirs.git_dir / 'HEAD').read_text().strip()
+    if head.startswith('ref: '):
+        return head.removeprefix('ref: ')
+    return None
+
+
+class UnsupportedLayout(Exception):
+    """The repository uses a feature the readers here don't understand; ask git instead."""
+
+
+CONFIG_SECTION = re.compile(r'^\[\s*([\w.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(.*)$')
+CONFIG_ENTRY = re.compile(r'^([A-Za-z][\w-]*)\s*(?:=\s*(.*))?$')
+
+
+def parse_config_value(value: str) -> str:
+    """Strip comments and quotes from a config value."""
+    out = []
+    quoted = False
+    escaped = False
+    for char in value:
+        if escaped:
+            out.append({'n': '\n', 't': '\t', 'b': '\b'}.get(char, char))
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char in '#;' and not quoted:
+            break
+        else:
+            out.append(char)
+    return ''.join(out).strip()
+
+
+def read_config(path: Path) -> dict[str, list[str]]:
+    """
+    Read a git config file into {'section.subsection.key': [values]}, with
+    section and key names lowercased as git does. Files using includes or
+    continuation lines raise UnsupportedLayout.
+    """
+    config: dict[str, list[str]] = {}
+    section = None
+    try:
+        lines = path.read_text().splitlines()
+    except FileNotFoundError:
+        return config
+
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+
+        m = CONFIG_SECTION.match(line)
+        if m is not None:
+            name, subsection, rest = m.groups()
+            section = name.lower()
+            if subsection is not None:
+                section += '.' + re.sub(r'\\(.)', r'\1', subsection)
+            if section == 'include' or section.startswith('includeif.'):
+                raise UnsupportedLayout(f'{path}: includes')
+            line = rest
+            if not line or line[0] in '#;':
+                continue
+
+        m = CONFIG_ENTRY.match(line)
+        if m is None or section is None or line.endswith('\\'):
+            raise UnsupportedLayout(f'{path}: cannot parse {line!r}')
+        key, value = m.groups()
+        # A key without a value is boolean true
+        value = 'true' if value is None else parse_config_value(value)
+        config.setdefault(f'{section}.{key.lower()}', []).append(value)
+
+    return config
+
+
+class RefStore:
+    """Resolve refs from loose ref files and packed-refs."""
+
+    def __init__(self, common_dir: Path):
+        self.common_dir = common_dir
+        self._packed: Optional[dict[str, str]] = None
+
+    @property
+    def packed(self) -> dict[str, str]:
+        if self._packed is None:
+            self._packed = {}
+            try:
+                lines = (self.common_dir / 'packed-refs').read_text().splitlines()
+            except FileNotFoundError:
+                lines = []
+            for line in lines:
+                # '#' starts the header, '^' the peeled commit of the tag above
+                if line and line[0] not in '#^':
+                    sha, ref = line.split(' ', 1)
+                    self._packed[ref] = sha
+        return self._packed
+
+    def list(self, prefix: str) -> dict[str, str]:
+        """All refs under `prefix` (e.g. 'refs/remotes/origin/'), symbolic ones resolved."""
+        refs = {ref: sha for ref, sha in self.packed.items() if ref.startswith(prefix)}
+        base = self.common_dir / prefix
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                ref = (Path(dirpath) / filename).relative_to(self.common_dir).as_posix()
+                sha = self.resolve(ref)
+                if sha is not None:
+                    refs[ref] = sha
+        return refs
+
+    def resolve(self, ref: str, depth: int = 0) -> Optional[str]:
+        """The object a ref points to, or None if the ref does not exist."""
+        if depth > 5:
+            raise UnsupportedLayout(f'symbolic ref loop at {ref}')
+        try:
+            value = (self.common_dir / ref).read_text().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return self.packed.get(ref)
+        if value.startswith('ref: '):
+            return self.resolve(value.removeprefix('ref: '), depth + 1)
+        return value
+
+
+def map_refspec(refspec: str, ref: str) -> Optional[str]:
+    """Map a remote ref through a fetch refspec like '+refs/heads/*:refs/remotes/origin/*'."""
+    src, _, dst = refspec.removeprefix('+').partition(':')
+    if '*' not in src:
+        return dst if src == ref else None
+    prefix, suffix = src.split('*', 1)
+    if ref.startswith(prefix) and ref.endswith(suffix) and len(ref) >= len(prefix) + len(suffix):
+        matched = ref[len(prefix):len(ref) - len(suffix)]
+        return dst.replace('*', matched, 1)
+    return None
+
+
+def shorten_ref(ref: str) -> str:
+    for prefix in ('refs/heads/', 'refs/remotes/', 'refs/tags/', 'refs/'):
+        if ref.startswith(prefix):
+            return ref.removeprefix(prefix)
+    return ref
+
+
+@dataclass
+class BranchInfo:
+    # None when HEAD is detached
+    branch: Optional[str]
+    # None on a branch without commits yet
+    commit: Optional[str]
+    # The upstream as git status shows it, e.g. 'origin/main'
+    upstream: Optional[str] = None
+    # None when the upstream is configured but its ref is gone
+    upstream_commit: Optional[str] = None
+
+
+def tracking_ref(config: dict, branch: str) -> Optional[str]:
+    """
+    The local ref that tracks the upstream of `branch`, e.g. 'refs/remotes/origin/main',
+    or a branch under refs/heads/ when it tracks another local branch. None without an upstream.
+    """
+    remote = config.get(f'branch.{branch}.remote', [None])[-1]
+    merge = config.get(f'branch.{branch}.merge', [None])[-1]
+    if remote is None or merge is None:
+        return None
+
+    if remote == '.':
+        return merge
+
+    refspecs = config.get(f'remote.{remote}.fetch', [])
+    return next(
+        (dst for dst in (map_refspec(spec, merge) for spec in refspecs) if dst is not None),
+        None,
+    )
+
+
+def read_branch_info(dirs: GitDirs) -> BranchInfo:
+    """
+    The checked out branch and its upstream, read straight from the files in
+    the git dir, the way `git status --branch` would report them.
+    """
+    config = read_config(dirs.common_dir / 'config')
+    if 'extensions.refstorage' in config or (dirs.common_dir / 'reftable').exists():
+        raise UnsupportedLayout(f'{dirs.common_dir}: reftable')
+
+    refs = RefStore(dirs.common_dir)
+    head = read_head(dirs)
+    if head is None:
+        commit = (dirs.git_dir / 'HEAD').read_text().strip()
+        return BranchInfo(branch=None, commit=commit)
+
+    branch = shorten_ref(head)
+    info = BranchInfo(branch=branch, commit=refs.resolve(head))
+
+    tracking = tracking_ref(config, branch)
+    if tracking is None:
+        return info
+
+    info.upstream = shorten_ref(tracking)
+    info.upstream_commit = refs.resolve(tracking)
+    return info
@@ -0,0 +1,114 @@
+import subprocess
+
+import pytest
+from dotfiles.git.repo import (
+    RefStore, UnsupportedLayout, find_git_dirs, map_refspec, read_branch_info, read_config,
+)
+
+
+def git(repo, *args):
+    return subprocess.run(
+        ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com', *args],
+        cwd=repo, check=True, capture_output=True, text=True,
+    ).stdout.strip()
+
+
+def test_read_config(tmp_path):
+    path = tmp_path / 'config'
+    path.write_text(
+        '[core]\n'
+        '\tbare = false  ; comment\n'
+        '[remote "origin"]\n'
+        '\turl = "git@example.com:a/b.git"\n'
+        '\tfetch = +refs/heads/*:refs/remotes/origin/*\n'
+        '\tFetch = +refs/tags/*:refs/tags/*\n'
+        '[branch "Feature/x"] remote = origin\n'
+        '\tmerge = refs/heads/feature/x # comment\n'
+        '\tRebase\n'
+    )
+
+    assert read_config(path) == {
+        'core.bare': ['false'],
+        'remote.origin.url': ['git@example.com:a/b.git'],
+        'remote.origin.fetch': ['+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*'],
+        'branch.Feature/x.remote': ['origin'],
+        'branch.Feature/x.merge': ['refs/heads/feature/x'],
+        'branch.Feature/x.rebase': ['true'],
+    }
+
+
+def test_read_config_include(tmp_path):
+    path = tmp_path / 'config'
+    path.write_text('[include]\n\tpath = other\n')
+
+    with pytest.raises(UnsupportedLayout):
+        read_config(path)
+
+
+@pytest.mark.parametrize("refspec,ref,expected", [
+    ('+refs/heads/*:refs/remotes/origin/*', 'refs/heads/main', 'refs/remotes/origin/main'),
+    ('+refs/heads/*:refs/remotes/origin/*', 'refs/tags/v1', None),
+    ('refs/heads/main:refs/remotes/origin/main', 'refs/heads/main', 'refs/remotes/origin/main'),
+    ('refs/heads/main:refs/remotes/origin/main', 'refs/heads/dev', None),
+    ('refs/heads/feature/*:refs/remotes/up/f/*', 'refs/heads/feature/a/b', 'refs/remotes/up/f/a/b'),
+])
+def test_map_refspec(refspec, ref, expected):
+    assert map_refspec(refspec, ref) == expected
+
+
+def test_read_branch_info(tmp_path):
+    origin = tmp_path / 'origin'
+    origin.mkdir()
+    git(origin, 'init', '-q', '-b', 'main')
+    git(origin, 'commit', '-q', '--allow-empty', '-m', 'initial')
+    git(tmp_path, 'clone', '-q', str(origin), 'clone')
+    clone = tmp_path / 'clone'
+    git(clone, 'pack-refs', '--all')
+
+    info = read_branch_info(find_git_dirs(clone))
+    assert info.branch == 'main'
+    assert info.upstream == 'origin/main'
+    assert info.commit == info.upstream_commit == git(clone, 'rev-parse', 'HEAD')
+
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'local')
+    git(clone, 'worktree', 'add', '-q', '-b', 'topic', str(tmp_path / 'topic'))
+    info = read_branch_info(find_git_dirs(tmp_path / 'topic'))
+    assert info.branch == 'topic'
+    assert info.upstream is None
+    assert info.commit == git(clone, 'rev-parse', 'main')
+
+
+def test_ref_store_packed_and_loose(tmp_path):
+    (tmp_path / 'refs' / 'heads').mkdir(parents=True)
+    (tmp_path / 'packed-refs').write_text(
+        '# pack-refs with: peeled fully-peeled sorted\n'
+        'aaaa refs/heads/main\n'
+        'bbbb refs/tags/v1\n'
+        '^cccc\n'
+    )
+    (tmp_path / 'refs' / 'heads' / 'main').write_text('dddd\n')
+    (tmp_path / 'refs' / 'heads' / 'alias').write_text('ref: refs/tags/v1\n')
+
+    refs = RefStore(tmp_path)
+    assert refs.resolve('refs/heads/main') == 'dddd'
+    assert refs.resolve('refs/heads/alias') == 'bbbb'
+    assert refs.resolve('refs/heads/missing') is None
+
+
+def test_ref_store_list(tmp_path):
+    (tmp_path / 'refs' / 'remotes' / 'origin' / 'feature').mkdir(parents=True)
+    (tmp_path / 'packed-refs').write_text(
+        'aaaa refs/remotes/origin/main\n'
+        'bbbb refs/remotes/origin/old\n'
+        'cccc refs/remotes/upstream/main\n'
+    )
+    (tmp_path / 'refs' / 'remotes' / 'origin' / 'main').write_text('dddd\n')
+    (tmp_path / 'refs' / 'remotes' / 'origin' / 'feature' / 'x').write_text('eeee\n')
+    (tmp_path / 'refs' / 'remotes' / 'origin' / 'HEAD').write_text('ref: refs/remotes/origin/main\n')
+
+    assert RefStore(tmp_path).list('refs/remotes/origin/') == {
+        'refs/remotes/origin/HEAD': 'dddd',
+        'refs/remotes/origin/main': 'dddd',
+        'refs/remotes/origin/old': 'bbbb',
+        'refs/remotes/origin/feature/x': 'eeee',
+    }
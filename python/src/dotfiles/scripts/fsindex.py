@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
+import argparse
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import select
 import sqlite3
+import struct
 import sys
-from dataclasses import dataclass
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait,
+)
+from dataclasses import dataclass, fields
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+
+from tabulate import tabulate
 
 
 # Row dict access
@@ -125,6 +144,206 @@ db_schemas = _SchemaRegistry.from_list([
         deleted_at datetime
     );
     """),
+    _SchemaVersion(2, """
+    -- Earlier versions inserted a new row on every run; keep only the latest one
+    delete from file
+    where id not in (select max(id) from file group by library_id, path);
+
+    create table directory (
+        id integer primary key autoincrement,
+        library_id integer not null,
+        path text not null,
+        mtime datetime,
+        created_at datetime not null default current_timestamp,
+        updated_at datetime not null default current_timestamp,
+        deleted_at datetime
+    );
+
+    create unique index directory_library_path on directory (library_id, path);
+
+    alter table file add column directory_id integer references directory (id);
+    alter table file add column inode integer;
+
+    create unique index file_library_path on file (library_id, path);
+    create index file_directory on file (directory_id);
+    """),
+    _SchemaVersion(3, """
+    -- Partial indexes: queries only look at files that still exist
+    create index file_live_name on file (name) where deleted_at is null;
+    create index file_live_size on file (size) where deleted_at is null;
+    create index file_live_mtime on file (mtime) where deleted_at is null;
+    """),
+    _SchemaVersion(4, """
+    -- Hashes are only valid while the file keeps the same (size, mtime, inode)
+    create table file_hash (
+        file_id integer primary key references file (id),
+        size integer not null,
+        mtime datetime not null,
+        inode integer,
+        partial_hash text,
+        content_hash text,
+        updated_at datetime not null default current_timestamp
+    );
+
+    create index file_hash_content on file_hash (content_hash);
+    """),
+    _SchemaVersion(5, """
+    -- Full-text index over names and paths of live files. It is an external
+    -- content table, so triggers keep it in sync with the file table.
+    create virtual table file_fts using fts5 (
+        name, path,
+        content = 'file', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    );
+
+    insert into file_fts (rowid, name, path)
+    select id, name, path from file where deleted_at is null;
+
+    create trigger file_fts_insert after insert on file
+    when new.deleted_at is null
+    begin
+        insert into file_fts (rowid, name, path) values (new.id, new.name, new.path);
+    end;
+
+    create trigger file_fts_delete after delete on file
+    when old.deleted_at is null
+    begin
+        insert into file_fts (file_fts, rowid, name, path)
+        values ('delete', old.id, old.name, old.path);
+    end;
+
+    create trigger file_fts_update after update of name, path, deleted_at on file
+    when old.deleted_at is not new.deleted_at
+        or old.name is not new.name
+        or old.path is not new.path
+    begin
+        insert into file_fts (file_fts, rowid, name, path)
+        select 'delete', old.id, old.name, old.path where old.deleted_at is null;
+        insert into file_fts (rowid, name, path)
+        select new.id, new.name, new.path where new.deleted_at is null;
+    end;
+    """),
+    _SchemaVersion(6, """
+    -- Files point at their directory instead of repeating its full path.
+    -- Rows not seen by a scan since version 2 get their directory created.
+    insert or ignore into directory (library_id, path)
+    select distinct library_id,
+        coalesce(nullif(rtrim(rtrim(path, replace(path, '/', '')), '/'), ''), '.')
+    from file
+    where directory_id is null;
+
+    update file set directory_id = (
+        select d.id from directory d
+        where d.library_id = file.library_id
+            and d.path = coalesce(
+                nullif(rtrim(rtrim(file.path, replace(file.path, '/', '')), '/'), ''), '.'
+            )
+    )
+    where directory_id is null;
+
+    drop table file_fts;
+
+    create table file_new (
+        id integer primary key autoincrement,
+        library_id integer not null,
+        directory_id integer not null references directory (id),
+        name text not null,
+        size integer not null,
+        mtime datetime not null,
+        inode integer,
+        created_at datetime not null default current_timestamp,
+        updated_at datetime not null default current_timestamp,
+        deleted_at datetime
+    );
+
+    insert into file_new (id, library_id, directory_id, name, size, mtime, inode,
+                          created_at, updated_at, deleted_at)
+    select id, library_id, directory_id, name, size, mtime, inode,
+        created_at, updated_at, deleted_at
+    from file;
+
+    drop table file;
+    alter table file_new rename to file;
+
+    create unique index file_directory_name on file (directory_id, name);
+    create index file_live_name on file (name) where deleted_at is null;
+    create index file_live_size on file (size) where deleted_at is null;
+    create index file_live_mtime on file (mtime) where deleted_at is null;
+    create index directory_path on directory (path);
+
+    create view file_path as
+    select f.id, f.library_id, f.directory_id, f.name,
+        case d.path when '.' then f.name else d.path || '/' || f.name end as path,
+        f.size, f.mtime, f.inode, f.created_at, f.updated_at, f.deleted_at
+    from file f
+    join directory d on d.id = f.directory_id;
+
+    -- Same full-text index as before, now reading paths through the view
+    create virtual table file_fts using fts5 (
+        name, path,
+        content = 'file_path', content_rowid = 'id',
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    );
+
+    insert into file_fts (rowid, name, path)
+    select id, name, path from file_path where deleted_at is null;
+
+    create trigger file_fts_insert after insert on file
+    when new.deleted_at is null
+    begin
+        insert into file_fts (rowid, name, path)
+        select id, name, path from file_path where id = new.id;
+    end;
+
+    create trigger file_fts_delete after delete on file
+    when old.deleted_at is null
+    begin
+        insert into file_fts (file_fts, rowid, name, path)
+        select 'delete', old.id, old.name,
+            case d.path when '.' then old.name else d.path || '/' || old.name end
+        from directory d where d.id = old.directory_id;
+    end;
+
+    create trigger file_fts_update after update of directory_id, name, deleted_at on file
+    when old.deleted_at is not new.deleted_at
+        or old.directory_id is not new.directory_id
+        or old.name is not new.name
+    begin
+        insert into file_fts (file_fts, rowid, name, path)
+        select 'delete', old.id, old.name,
+            case d.path when '.' then old.name else d.path || '/' || old.name end
+        from directory d where d.id = old.directory_id and old.deleted_at is null;
+        insert into file_fts (rowid, name, path)
+        select id, name, path from file_path where id = new.id and new.deleted_at is null;
+    end;
+    """),
+    _SchemaVersion(7, """
+    create table scan_run (
+        id integer primary key autoincrement,
+        library_id integer not null references library (id),
+        full integer not null default 0,
+        -- running, interrupted, finished or abandoned
+        status text not null default 'running',
+        started_at datetime not null default current_timestamp,
+        finished_at datetime,
+        elapsed real not null default 0,
+        dirs_listed integer not null default 0,
+        dirs_skipped integer not null default 0,
+        dirs_deleted integer not null default 0,
+        files_added integer not null default 0,
+        files_updated integer not null default 0,
+        files_unchanged integer not null default 0,
+        files_deleted integer not null default 0,
+        files_per_second real
+    );
+
+    create index scan_run_library on scan_run (library_id, id);
+
+    -- The scan run that last finished listing this directory
+    alter table directory add column scan_run_id integer references scan_run (id);
+    """),
 ])
 
 @dataclass
@@ -139,6 +358,29 @@ class File:
     path: Path
     size: int
     mtime: datetime.datetime
+    inode: Optional[int] = None
+
+
+@dataclass
+class Directory:
+    id: int
+    path: str
+    mtime: Optional[str]
+    scan_run_id: Optional[int] = None
+
+
+@dataclass
+class ScanStats:
+    dirs_listed: int = 0
+    dirs_skipped: int = 0
+    dirs_deleted: int = 0
+    files_added: int = 0
+    files_updated: int = 0
+    files_unchanged: int = 0
+    files_deleted: int = 0
+
+    def files_seen(self) -> int:
+        return self.files_added + self.files_updated + self.files_unchanged
 
 
 def list_libraries(cur: sqlite3.Cursor) -> list[Library]:
@@ -156,19 +398,1364 @@ def add_library(cur: sqlite3.Cursor, name: str, mount_path: Optional[str] = None
     )
 
 
-def add_file(cur: sqlite3.Cursor, library_id: int, fileinfo: File):
-    sql = """
-        insert into file (library_id, name, path, size, mtime)
-        values (?, ?, ?, ?, ?);
-    """
-    params = (
+UPSERT_FILE_SQL = """
+    insert into file (library_id, directory_id, name, size, mtime, inode)
+    values (?, ?, ?, ?, ?, ?)
+    on conflict (directory_id, name) do update set
+        size = excluded.size,
+        mtime = excluded.mtime,
+        inode = excluded.inode,
+        updated_at = current_timestamp,
+        deleted_at = null;
+"""
+
+
+def _file_params(library_id: int, fileinfo: File, directory_id: int) -> tuple:
+    return (
         library_id,
+        directory_id,
         fileinfo.path.name,
-        str(fileinfo.path),
         fileinfo.size,
         fileinfo.mtime,
+        fileinfo.inode,
+    )
+
+
+def add_file(cur: sqlite3.Cursor, library_id: int, fileinfo: File,
+             directory_id: Optional[int] = None):
+    """Insert a file, or update it (and undelete it) if its path is already known."""
+    if directory_id is None:
+        directory_id = add_directory(cur, library_id, str(fileinfo.path.parent))
+    cur.execute(UPSERT_FILE_SQL, _file_params(library_id, fileinfo, directory_id))
+
+
+def add_directory(cur: sqlite3.Cursor, library_id: int, path: str) -> int:
+    """
+    Insert a directory, or undelete it if already known. Its recorded mtime
+    is left alone until `set_directory_mtime` marks it as completely scanned.
+    """
+    sql = """
+        insert into directory (library_id, path)
+        values (?, ?)
+        on conflict (library_id, path) do update set
+            updated_at = current_timestamp,
+            deleted_at = null
+        returning id;
+    """
+    res = cur.execute(sql, (library_id, path))
+    return res.fetchone()['id']
+
+
+def set_directory_mtime(cur: sqlite3.Cursor, directory_id: int,
+                        mtime: Optional[datetime.datetime]):
+    cur.execute(
+        "update directory set mtime = ?, updated_at = current_timestamp where id = ?",
+        (mtime, directory_id),
+    )
+
+
+def list_directories(cur: sqlite3.Cursor, library_id: int) -> dict[str, Directory]:
+    res = cur.execute(
+        """
+        select id, path, mtime, scan_run_id from directory
+        where library_id = ? and deleted_at is null
+        """,
+        (library_id,),
+    )
+    return {row['path']: Directory(**row) for row in res.fetchall()}
+
+
+def list_directory_files(cur: sqlite3.Cursor, directory_id: int) -> dict[str, dict]:
+    res = cur.execute(
+        """
+        select id, name, size, mtime, inode from file
+        where directory_id = ? and deleted_at is null
+        """,
+        (directory_id,),
+    )
+    return {row['name']: row for row in res.fetchall()}
+
+
+def delete_files(cur: sqlite3.Cursor, file_ids: list[int], now: datetime.datetime):
+    cur.executemany(
+        "update file set deleted_at = ? where id = ?",
+        [(now, file_id) for file_id in file_ids],
+    )
+
+
+def delete_directories(cur: sqlite3.Cursor, directory_ids: list[int],
+                       now: datetime.datetime) -> int:
+    """
+    Soft-delete directories and every file still alive inside them. Returns
+    the number of files deleted.
+    """
+    cur.executemany(
+        "update directory set deleted_at = ? where id = ?",
+        [(now, directory_id) for directory_id in directory_ids],
+    )
+    cur.executemany(
+        "update file set deleted_at = ? where directory_id = ? and deleted_at is null",
+        [(now, directory_id) for directory_id in directory_ids],
+    )
+    return max(cur.rowcount, 0)
+
+
+# Bulk ingest
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_COMMIT_SIZE = 50_000
+DEFAULT_CACHE_MIB = 256
+
+
+def tune_for_ingest(con: sqlite3.Connection, cache_mib: int = DEFAULT_CACHE_MIB):
+    """
+    Relax durability for the current connection: with WAL, NORMAL only risks
+    losing the last commits on power loss, never corrupting the database.
+
+    The safety level can't change inside a transaction, and connections from
+    `connect` always have one open: the pragmas run in autocommit mode.
+    """
+    autocommit = con.autocommit
+    con.autocommit = True
+    try:
+        con.execute("pragma synchronous = normal")
+        con.execute(f"pragma cache_size = {-cache_mib * 1024}")
+        con.execute("pragma temp_store = memory")
+    finally:
+        con.autocommit = autocommit
+
+
+class IndexWriter:
+    """
+    Buffers index changes and writes them in batches with `executemany`.
+
+    Rows are written every `batch_size` changes and committed every
+    `commit_size` changes. A directory's mtime (and the `scan_run_id` that
+    checkpoints it) is only written after all of its file changes, so an
+    interrupted scan never leaves behind a directory that looks up to date
+    while some of its files are missing. `before_commit` runs inside each
+    transaction, just before it is committed.
+    """
+
+    def __init__(self, con: sqlite3.Connection, library_id: int,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 commit_size: int = DEFAULT_COMMIT_SIZE,
+                 scan_run_id: Optional[int] = None,
+                 before_commit: Optional[Callable[[], None]] = None):
+        self.con = con
+        self.cur = con.cursor()
+        self.library_id = library_id
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.scan_run_id = scan_run_id
+        self.before_commit = before_commit
+
+        self._files: list[tuple] = []
+        self._deleted: list[tuple] = []
+        self._directories: list[tuple] = []
+        self._uncommitted = 0
+
+    def directory(self, path: str) -> int:
+        return add_directory(self.cur, self.library_id, path)
+
+    def add_file(self, fileinfo: File, directory_id: int):
+        self._files.append(_file_params(self.library_id, fileinfo, directory_id))
+        self._changed()
+
+    def delete_file(self, file_id: int, now: datetime.datetime):
+        self._deleted.append((now, file_id))
+        self._changed()
+
+    def directory_done(self, directory_id: int, mtime: Optional[datetime.datetime]):
+        self._directories.append((mtime, self.scan_run_id, directory_id))
+        self._changed()
+
+    def _changed(self):
+        pending = len(self._files) + len(self._deleted) + len(self._directories)
+        if pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        pending = len(self._files) + len(self._deleted) + len(self._directories)
+        if self._files:
+            self.cur.executemany(UPSERT_FILE_SQL, self._files)
+        if self._deleted:
+            self.cur.executemany("update file set deleted_at = ? where id = ?", self._deleted)
+        if self._directories:
+            self.cur.executemany(
+                """
+                update directory set mtime = ?, scan_run_id = ?, updated_at = current_timestamp
+                where id = ?
+                """,
+                self._directories,
+            )
+        self._files.clear()
+        self._deleted.clear()
+        self._directories.clear()
+
+        self._uncommitted += pending
+        if self._uncommitted >= self.commit_size:
+            self.commit()
+
+    def commit(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.con.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.commit()
+
+
+class Progress:
+    """Single-line progress meter on stderr, redrawn at most every `interval` seconds."""
+
+    def __init__(self, interval: float = 0.5, stream=sys.stderr):
+        self.interval = interval
+        self.stream = stream
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def update(self, stats: 'ScanStats', force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+
+        elapsed = max(now - self.started, 1e-9)
+        files = stats.files_seen()
+        dirs = stats.dirs_listed + stats.dirs_skipped
+        print(
+            f"\r{dirs} dirs, {files} files ({files / elapsed:.0f} files/s)",
+            end='', file=self.stream, flush=True,
+        )
+
+    def close(self, stats: 'ScanStats'):
+        self.update(stats, force=True)
+        print(file=self.stream)
+
+
+# Scanning
+
+# Directory mtimes this close to the scan start are not trusted on the next
+# run: the directory may still change within the same timestamp granularity.
+RACY_MTIME_WINDOW = datetime.timedelta(seconds=2)
+
+# Listing is dominated by stat latency, not CPU, so this is worth raising on
+# network or USB-attached disks.
+DEFAULT_JOBS = 8
+
+
+def _mtime(stat: os.stat_result) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(stat.st_mtime, datetime.UTC)
+
+
+@dataclass
+class DirectoryListing:
+    path: Path
+    mtime: datetime.datetime
+    # None when the directory was not listed (unchanged or unreadable)
+    files: Optional[list[File]]
+    subdirs: list[Path]
+
+
+def read_directory(root: Path, reldir: Path,
+                   skip_if_mtime: Optional[str] = None,
+                   skip: bool = False) -> Optional[DirectoryListing]:
+    """
+    List a directory with `os.scandir`, stat'ing its files through the
+    `DirEntry` objects. Returns None if the directory is gone.
+    """
+    try:
+        mtime = _mtime((root / reldir).stat(follow_symlinks=False))
+    except FileNotFoundError:
+        return None
+
+    if skip or (skip_if_mtime is not None and skip_if_mtime == mtime.isoformat()):
+        return DirectoryListing(reldir, mtime, files=None, subdirs=[])
+
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(root / reldir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(reldir / entry.name)
+                    continue
+
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+
+                files.append(File(
+                    path=reldir / entry.name,
+                    size=stat.st_size,
+                    mtime=_mtime(stat),
+                    inode=stat.st_ino,
+                ))
+    except FileNotFoundError:
+        return None
+    except OSError:
+        # Unreadable: keep whatever was indexed before
+        return DirectoryListing(reldir, mtime, files=None, subdirs=[])
+
+    return DirectoryListing(reldir, mtime, files=files, subdirs=subdirs)
+
+
+class LibraryRootChanged(Exception):
+    pass
+
+
+SCAN_RUN_COUNTERS = [f.name for f in fields(ScanStats)]
+
+
+@dataclass
+class ScanRun:
+    id: int
+    full: bool
+    elapsed: float
+    stats: ScanStats
+    resumed: bool = False
+
+
+def start_scan_run(cur: sqlite3.Cursor, library_id: int, full: bool) -> ScanRun:
+    """
+    Resume the library's unfinished scan run, or start a new one. An
+    unfinished run of the other kind (full or incremental) is abandoned.
+    """
+    row = cur.execute(
+        """
+        select * from scan_run
+        where library_id = ? and finished_at is null
+        order by id desc limit 1
+        """,
+        (library_id,),
+    ).fetchone()
+
+    if row is not None and bool(row['full']) == full:
+        stats = ScanStats(**{name: row[name] for name in SCAN_RUN_COUNTERS})
+        cur.execute("update scan_run set status = 'running' where id = ?", (row['id'],))
+        return ScanRun(row['id'], full, row['elapsed'], stats, resumed=True)
+
+    if row is not None:
+        cur.execute(
+            "update scan_run set status = 'abandoned', finished_at = current_timestamp where id = ?",
+            (row['id'],),
+        )
+
+    res = cur.execute(
+        "insert into scan_run (library_id, full) values (?, ?) returning id",
+        (library_id, full),
+    )
+    return ScanRun(res.fetchone()['id'], full, 0.0, ScanStats())
+
+
+def update_scan_run(cur: sqlite3.Cursor, run: ScanRun, elapsed: float,
+                    status: str = 'running'):
+    values = {name: getattr(run.stats, name) for name in SCAN_RUN_COUNTERS}
+    assignments = ', '.join(f"{name} = :{name}" for name in values)
+    finished = status == 'finished'
+    cur.execute(
+        f"""
+        update scan_run set {assignments}, status = :status, elapsed = :elapsed,
+            finished_at = case when :finished then current_timestamp end,
+            files_per_second = case when :finished and :elapsed > 0
+                then :files_seen / :elapsed end
+        where id = :id
+        """,
+        {
+            **values,
+            'id': run.id,
+            'status': status,
+            'elapsed': elapsed,
+            'finished': finished,
+            'files_seen': run.stats.files_seen(),
+        },
+    )
+
+
+def list_scan_runs(cur: sqlite3.Cursor, library: Optional[str] = None,
+                   limit: int = 20) -> list[dict]:
+    conditions = "where l.name = ?" if library is not None else ""
+    params = [library] if library is not None else []
+    return cur.execute(
+        f"""
+        select r.*, l.name as library from scan_run r
+        join library l on l.id = r.library_id
+        {conditions}
+        order by r.id desc limit ?
+        """,
+        [*params, limit],
+    ).fetchall()
+
+
+def scan_library(con: sqlite3.Connection, lib: Library, root: Path,
+                 full: bool = False,
+                 jobs: int = DEFAULT_JOBS,
+                 batch_size: int = DEFAULT_BATCH_SIZE,
+                 commit_size: int = DEFAULT_COMMIT_SIZE,
+                 progress: Optional[Progress] = None,
+                 allow_empty: bool = False) -> ScanStats:
+    """
+    Bring the index of a library up to date with the files under `root`.
+
+    A directory whose mtime matches the one recorded on the previous scan has
+    had no entries added, removed or renamed, so it is not listed again and
+    its files keep their recorded metadata; its subdirectories are still
+    visited, since changes deeper in the tree do not bubble up. Files modified
+    in place do not touch their directory's mtime: pass `full=True` to list
+    every directory and compare every file's (size, mtime, inode).
+
+    Directories are listed by up to `jobs` threads; all database work stays
+    on the calling thread, which owns `con`.
+
+    Each scan is recorded in `scan_run`, and every directory is checkpointed
+    with the run that listed it as changes get committed. If a scan is
+    interrupted, the next one of the same kind resumes it, skipping the
+    directories it had already finished.
+
+    Files and directories that are gone get their `deleted_at` set. An empty
+    `root` is most likely an unmounted drive, so it raises LibraryRootChanged
+    while the library has indexed files, unless `allow_empty` is set.
+    """
+    cur = con.cursor()
+    root_dev = root.stat().st_dev
+    if not allow_empty:
+        _check_root_not_empty(cur, lib, root)
+    started = time.monotonic()
+    now = datetime.datetime.now(datetime.UTC)
+
+    with con:
+        run = start_scan_run(cur, lib.id, full)
+    stats = run.stats
+
+    def checkpoint(status: str = 'running'):
+        update_scan_run(cur, run, run.elapsed + time.monotonic() - started, status)
+
+    writer = IndexWriter(
+        con, lib.id, batch_size=batch_size, commit_size=commit_size,
+        scan_run_id=run.id, before_commit=checkpoint,
+    )
+
+    known_dirs = list_directories(cur, lib.id)
+    known_children: dict[str, list[str]] = {}
+    for dirpath in known_dirs:
+        if dirpath != '.':
+            known_children.setdefault(str(Path(dirpath).parent), []).append(dirpath)
+
+    visited = set()
+
+    def submit(pool: ThreadPoolExecutor, reldir: Path) -> Future:
+        known = known_dirs.get(str(reldir))
+        if known is None:
+            return pool.submit(read_directory, root, reldir)
+        if run.resumed and known.scan_run_id == run.id:
+            return pool.submit(read_directory, root, reldir, skip=True)
+        return pool.submit(read_directory, root, reldir, None if full else known.mtime)
+
+    pool = ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='fsindex')
+    try:
+        pending = {submit(pool, Path('.'))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                listing = future.result()
+                if listing is None:
+                    continue
+
+                key = str(listing.path)
+                visited.add(key)
+
+                if listing.files is None:
+                    stats.dirs_skipped += 1
+                    pending.update(
+                        submit(pool, Path(child)) for child in known_children.get(key, [])
+                    )
+                    continue
+
+                pending.update(submit(pool, subdir) for subdir in listing.subdirs)
+                _apply_listing(cur, writer, listing, key in known_dirs, stats, now)
+
+                if progress is not None:
+                    progress.update(stats)
+
+        writer.flush()
+
+        # An unmounted drive looks like an empty directory: don't take that
+        # as every file being deleted.
+        if root.stat().st_dev != root_dev:
+            raise LibraryRootChanged(f"{root} changed device during the scan; was it unmounted?")
+
+        gone = [d.id for path, d in known_dirs.items() if path not in visited]
+        stats.files_deleted += delete_directories(cur, gone, now)
+        stats.dirs_deleted += len(gone)
+
+        checkpoint('finished')
+        con.commit()
+    except BaseException:
+        # Whatever was written is consistent: directories only get their
+        # checkpoint together with all of their files.
+        pool.shutdown(wait=True, cancel_futures=True)
+        writer.flush()
+        checkpoint('interrupted')
+        con.commit()
+        raise
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        if progress is not None:
+            progress.close(stats)
+
+    return stats
+
+
+def _check_root_not_empty(cur: sqlite3.Cursor, lib: Library, root: Path):
+    with os.scandir(root) as it:
+        if next(it, None) is not None:
+            return
+    live = cur.execute(
+        "select count(*) as n from file where library_id = ? and deleted_at is null",
+        (lib.id,),
+    ).fetchone()['n']
+    if live:
+        raise LibraryRootChanged(
+            f"{root} is empty but {live} files of library {lib.name!r} are indexed; was it unmounted?"
+        )
+
+
+def _apply_listing(cur: sqlite3.Cursor, writer: IndexWriter, listing: DirectoryListing,
+                   known: bool, stats: ScanStats, now: datetime.datetime):
+    stats.dirs_listed += 1
+    directory_id = writer.directory(str(listing.path))
+    # Record subdirectories right away: once this directory is checkpointed,
+    # later scans may skip it and only descend into subdirectories they know.
+    for subdir in listing.subdirs:
+        writer.directory(str(subdir))
+    known_files = list_directory_files(cur, directory_id) if known else {}
+
+    for fileinfo in listing.files:
+        previous = known_files.pop(fileinfo.path.name, None)
+        if previous is not None and (
+            previous['size'] == fileinfo.size
+            and previous['mtime'] == fileinfo.mtime.isoformat()
+            and previous['inode'] == fileinfo.inode
+        ):
+            stats.files_unchanged += 1
+            continue
+
+        writer.add_file(fileinfo, directory_id)
+        if previous is None:
+            stats.files_added += 1
+        else:
+            stats.files_updated += 1
+
+    for row in known_files.values():
+        writer.delete_file(row['id'], now)
+    stats.files_deleted += len(known_files)
+
+    recorded_mtime = listing.mtime if now - listing.mtime > RACY_MTIME_WINDOW else None
+    writer.directory_done(directory_id, recorded_mtime)
+
+
+# Watch mode
+
+class InotifyEvent(NamedTuple):
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes (Linux only)."""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_DONT_FOLLOW = 0x02000000
+    IN_ISDIR = 0x40000000
+
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(f"inotify is not available in {libc_name}")
+
+        self.fd = self._check(self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC))
+
+    def _check(self, result: int, path: Optional[Path] = None) -> int:
+        if result < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return result
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        return self._check(self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask), path)
+
+    def rm_watch(self, wd: int):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: Optional[float]) -> list[InotifyEvent]:
+        """Wait up to `timeout` seconds for events and return all that are queued."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append(InotifyEvent(wd, mask, cookie, os.fsdecode(name)))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _glob_escape(text: str) -> str:
+    return re.sub(r'([*?[])', r'[\1]', text)
+
+
+def delete_directory_tree(cur: sqlite3.Cursor, library_id: int, path: str,
+                          now: datetime.datetime) -> tuple[int, int]:
+    """Soft-delete a directory and everything below it. Returns (directories, files) deleted."""
+    if path == '.':
+        res = cur.execute(
+            "select id from directory where library_id = ? and deleted_at is null",
+            (library_id,),
+        )
+    else:
+        res = cur.execute(
+            """
+            select id from directory
+            where library_id = ? and deleted_at is null and (path = ? or path glob ?)
+            """,
+            (library_id, path, _glob_escape(path) + '/*'),
+        )
+    ids = [row['id'] for row in res.fetchall()]
+    return len(ids), delete_directories(cur, ids, now)
+
+
+def list_child_directories(cur: sqlite3.Cursor, library_id: int, path: str) -> set[str]:
+    pattern = '*' if path == '.' else _glob_escape(path) + '/*'
+    res = cur.execute(
+        """
+        select path from directory
+        where library_id = ? and deleted_at is null and path glob ? and path != '.'
+        """,
+        (library_id, pattern),
+    )
+    prefix = '' if path == '.' else path + '/'
+    return {
+        row['path'] for row in res.fetchall()
+        if '/' not in row['path'].removeprefix(prefix)
+    }
+
+
+class LibraryWatcher:
+    """
+    Keep a library's index live from inotify events.
+
+    Events only mark directories as dirty. Bursts are coalesced: once an
+    event arrives, more are collected until none came for `settle`
+    seconds, or `max_delay` seconds went by. Then each dirty directory is
+    listed again and applied in one batch of writes. Anything that
+    happened while not watching, or lost to a queue overflow, is picked up
+    by an incremental `scan_library`.
+    """
+
+    WATCH_MASK = (
+        Inotify.IN_ATTRIB | Inotify.IN_CLOSE_WRITE | Inotify.IN_CREATE | Inotify.IN_DELETE
+        | Inotify.IN_MOVED_FROM | Inotify.IN_MOVED_TO
+        | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF
+        | Inotify.IN_ONLYDIR | Inotify.IN_DONT_FOLLOW
+    )
+
+    def __init__(self, con: sqlite3.Connection, lib: Library, root: Path,
+                 settle: float = 0.5, max_delay: float = 5.0,
+                 poll_interval: float = 1.0):
+        self.con = con
+        self.lib = lib
+        self.root = root
+        self.settle = settle
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+
+        self.inotify = Inotify()
+        self._paths: dict[int, str] = {}
+
+    def watch(self, reldir: Path):
+        try:
+            wd = self.inotify.add_watch(self.root / reldir, self.WATCH_MASK)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise OSError(e.errno, "out of inotify watches; raise fs.inotify.max_user_watches") from e
+            raise
+        # Watching the same inode again (e.g. a moved directory) reuses its wd
+        self._paths[wd] = str(reldir)
+
+    def watch_tree(self, reldir: Path):
+        self.watch(reldir)
+        try:
+            with os.scandir(self.root / reldir) as it:
+                subdirs = [e.name for e in it if e.is_dir(follow_symlinks=False)]
+        except OSError:
+            return
+        for name in subdirs:
+            self.watch_tree(reldir / name)
+
+    def unwatch_tree(self, path: str):
+        prefix = path + '/'
+        for wd, watched in list(self._paths.items()):
+            if path == '.' or watched == path or watched.startswith(prefix):
+                self.inotify.rm_watch(wd)
+                del self._paths[wd]
+
+    def collect(self, stop: Optional[threading.Event] = None) -> tuple[set[str], bool]:
+        """Wait for a burst of events. Returns the dirty directories and whether events were lost."""
+        events = self.inotify.read(self.poll_interval)
+        if not events:
+            return set(), False
+
+        deadline = time.monotonic() + self.max_delay
+        while (remaining := deadline - time.monotonic()) > 0:
+            if stop is not None and stop.is_set():
+                break
+            more = self.inotify.read(min(self.settle, remaining))
+            if not more:
+                break
+            events.extend(more)
+
+        dirty = set()
+        overflow = False
+        for event in events:
+            if event.mask & Inotify.IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            path = self._paths.get(event.wd)
+            if path is None:
+                continue
+            if event.mask & Inotify.IN_IGNORED:
+                del self._paths[event.wd]
+                continue
+
+            dirty.add(path)
+            if event.mask & (Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF) and path != '.':
+                dirty.add(str(Path(path).parent))
+
+        return dirty, overflow
+
+    def refresh(self, dirty: set[str]) -> ScanStats:
+        """List dirty directories again, following new and vanished subdirectories."""
+        cur = self.con.cursor()
+        writer = IndexWriter(self.con, self.lib.id)
+        stats = ScanStats()
+        now = datetime.datetime.now(datetime.UTC)
+
+        pending = sorted(dirty, key=lambda path: path.count('/'), reverse=True)
+        while pending:
+            path = pending.pop()
+            listing = read_directory(self.root, Path(path))
+            if listing is None or listing.files is None:
+                if listing is None:
+                    dirs, files = delete_directory_tree(cur, self.lib.id, path, now)
+                    stats.dirs_deleted += dirs
+                    stats.files_deleted += files
+                    self.unwatch_tree(path)
+                continue
+
+            known = list_child_directories(cur, self.lib.id, path)
+            _apply_listing(cur, writer, listing, True, stats, now)
+
+            current = {str(subdir) for subdir in listing.subdirs}
+            for subdir in current - known:
+                self.watch(Path(subdir))
+                pending.append(subdir)
+            for subdir in known - current:
+                dirs, files = delete_directory_tree(cur, self.lib.id, subdir, now)
+                stats.dirs_deleted += dirs
+                stats.files_deleted += files
+                self.unwatch_tree(subdir)
+
+        writer.close()
+        return stats
+
+    def run(self, stop: Optional[threading.Event] = None,
+            on_change: Optional[Callable[[ScanStats], None]] = None):
+        self.watch_tree(Path('.'))
+        stats = scan_library(self.con, self.lib, self.root)
+        if on_change is not None:
+            on_change(stats)
+
+        while stop is None or not stop.is_set():
+            dirty, overflow = self.collect(stop)
+            if overflow:
+                self.watch_tree(Path('.'))
+                stats = scan_library(self.con, self.lib, self.root)
+            elif dirty:
+                stats = self.refresh(dirty)
+            else:
+                continue
+
+            if on_change is not None:
+                on_change(stats)
+
+    def close(self):
+        self.inotify.close()
+
+
+# Queries
+
+@dataclass
+class FileQuery:
+    library: Optional[str] = None
+    name: Optional[str] = None
+    path: Optional[str] = None
+    since: Optional[datetime.datetime] = None
+    largest: bool = False
+    limit: Optional[int] = None
+
+    def to_sql(self) -> tuple[str, list]:
+        """
+        Build the query for these filters. `name` and `path` are GLOB patterns,
+        which (unlike LIKE) are case-sensitive and can use the indexes as long
+        as they do not start with a wildcard.
+        """
+        conditions = ["f.deleted_at is null"]
+        params = []
+
+        if self.library is not None:
+            conditions.append("l.name = ?")
+            params.append(self.library)
+        if self.name is not None:
+            conditions.append("f.name glob ?")
+            params.append(self.name)
+        if self.path is not None:
+            # Narrow down by directory first: paths are not stored per file
+            literal = re.split(r'[*?[]', self.path, maxsplit=1)[0]
+            if '/' in literal:
+                conditions.append("f.directory_id in (select id from directory where path glob ?)")
+                params.append(literal.rsplit('/', 1)[0] + '*')
+            conditions.append("f.path glob ?")
+            params.append(self.path)
+        if self.since is not None:
+            conditions.append("f.mtime >= ?")
+            params.append(self.since)
+
+        if self.largest:
+            order = "f.size desc"
+        elif self.since is not None:
+            order = "f.mtime desc"
+        else:
+            order = "l.name, f.path"
+
+        sql = f"""
+            select l.name as library, f.path, f.size, f.mtime
+            from file_path f
+            join library l on l.id = f.library_id
+            where {' and '.join(conditions)}
+            order by {order}
+        """
+        if self.limit is not None:
+            sql += " limit ?"
+            params.append(self.limit)
+
+        return sql, params
+
+
+def find_files(cur: sqlite3.Cursor, query: FileQuery) -> list[dict]:
+    sql, params = query.to_sql()
+    return cur.execute(sql, params).fetchall()
+
+
+# Content hashing and duplicates
+
+# Same-size files are first told apart by hashing this much from each end
+PARTIAL_HASH_SIZE = 64 * 1024
+HASH_ALGORITHM = 'blake2b'
+
+VALID_HASH_JOIN = """
+    file_hash h on h.file_id = f.id
+        and h.size = f.size and h.mtime = f.mtime and h.inode is f.inode
+"""
+
+
+@dataclass
+class HashStats:
+    cached: int = 0
+    partial_hashed: int = 0
+    fully_hashed: int = 0
+    unreadable: int = 0
+
+
+def _open_unchanged(path: Path, size: int):
+    """Open a file for hashing, or return None if it is gone or no longer matches the index."""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    if os.fstat(f.fileno()).st_size != size:
+        f.close()
+        return None
+    return f
+
+
+def partial_hash(job: tuple[Path, int]) -> Optional[str]:
+    """
+    Hash the first and last PARTIAL_HASH_SIZE bytes of a file. Files up to
+    twice that size are read whole, so their partial hash is their content hash.
+    """
+    path, size = job
+    f = _open_unchanged(path, size)
+    if f is None:
+        return None
+
+    with f:
+        h = hashlib.new(HASH_ALGORITHM, f.read(PARTIAL_HASH_SIZE))
+        if size > 2 * PARTIAL_HASH_SIZE:
+            f.seek(-PARTIAL_HASH_SIZE, os.SEEK_END)
+        h.update(f.read(PARTIAL_HASH_SIZE))
+    return h.hexdigest()
+
+
+def content_hash(job: tuple[Path, int]) -> Optional[str]:
+    path, size = job
+    f = _open_unchanged(path, size)
+    if f is None:
+        return None
+
+    with f:
+        return hashlib.file_digest(f, HASH_ALGORITHM).hexdigest()
+
+
+def _library_filter(cur: sqlite3.Cursor, libraries: Optional[list[str]]) -> tuple[str, list]:
+    if not libraries:
+        return "", []
+    ids = [l.id for l in list_libraries(cur) if l.name in libraries]
+    return f" and f.library_id in ({', '.join('?' * len(ids))})", ids
+
+
+def hash_candidates(con: sqlite3.Connection, libraries: Optional[list[str]] = None,
+                    min_size: int = 1, jobs: Optional[int] = None) -> HashStats:
+    """
+    Compute content hashes for files that may have duplicates.
+
+    Only files sharing their size with another file are considered. Those
+    get a partial hash, and only files whose (size, partial hash) still
+    collide are read whole. Hashing runs in a pool of `jobs` processes;
+    hashes already stored for the same (size, mtime, inode) are reused.
+    Files of libraries without a mount path can't be read and are left out.
+    """
+    cur = con.cursor()
+    stats = HashStats()
+    library_sql, library_params = _library_filter(cur, libraries)
+
+    res = cur.execute(
+        f"""
+        select f.id, f.path, f.size, f.mtime, f.inode, l.mount_path,
+            h.partial_hash, h.content_hash
+        from file_path f
+        join library l on l.id = f.library_id
+        left join {VALID_HASH_JOIN}
+        where f.deleted_at is null and l.mount_path is not null and f.size in (
+            select f.size from file f
+            where f.deleted_at is null and f.size >= ? {library_sql}
+            group by f.size having count(*) > 1
+        ) {library_sql}
+        """,
+        [min_size, *library_params, *library_params],
+    )
+    candidates = res.fetchall()
+
+    def run(pool, hash_function, rows):
+        jobs = [(Path(row['mount_path']) / row['path'], row['size']) for row in rows]
+        return pool.map(hash_function, jobs, chunksize=64)
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        unhashed = [row for row in candidates if row['partial_hash'] is None]
+        for row, digest in zip(unhashed, run(pool, partial_hash, unhashed)):
+            row['partial_hash'] = digest
+            if digest is not None and row['size'] <= 2 * PARTIAL_HASH_SIZE:
+                row['content_hash'] = digest
+        stats.partial_hashed = len(unhashed)
+        stats.cached = len(candidates) - len(unhashed)
+
+        collisions: dict[tuple, list[dict]] = {}
+        for row in candidates:
+            if row['partial_hash'] is not None:
+                collisions.setdefault((row['size'], row['partial_hash']), []).append(row)
+
+        unhashed = [
+            row
+            for group in collisions.values() if len(group) > 1
+            for row in group if row['content_hash'] is None
+        ]
+        for row, digest in zip(unhashed, run(pool, content_hash, unhashed)):
+            row['content_hash'] = digest
+        stats.fully_hashed = len(unhashed)
+
+    stats.unreadable = sum(1 for row in candidates if row['partial_hash'] is None)
+
+    with con:
+        cur.executemany(
+            """
+            insert into file_hash (file_id, size, mtime, inode, partial_hash, content_hash)
+            values (:id, :size, :mtime, :inode, :partial_hash, :content_hash)
+            on conflict (file_id) do update set
+                size = excluded.size,
+                mtime = excluded.mtime,
+                inode = excluded.inode,
+                partial_hash = excluded.partial_hash,
+                content_hash = excluded.content_hash,
+                updated_at = current_timestamp
+            """,
+            [row for row in candidates if row['partial_hash'] is not None],
+        )
+
+    return stats
+
+
+def find_duplicates(cur: sqlite3.Cursor, libraries: Optional[list[str]] = None,
+                    min_size: int = 1) -> list[list[dict]]:
+    """Group live files by stored content hash, largest files first."""
+    library_sql, library_params = _library_filter(cur, libraries)
+
+    res = cur.execute(
+        f"""
+        select h.content_hash, f.size, l.name as library, f.path
+        from file_path f
+        join library l on l.id = f.library_id
+        join {VALID_HASH_JOIN}
+        where f.deleted_at is null and f.size >= ? {library_sql}
+            and h.content_hash in (
+                select h.content_hash from file f
+                join {VALID_HASH_JOIN}
+                where f.deleted_at is null {library_sql}
+                group by h.content_hash having count(*) > 1
+            )
+        order by f.size desc, h.content_hash, l.name, f.path
+        """,
+        [min_size, *library_params, *library_params],
     )
-    cur.execute(sql, params)
+
+    groups: dict[str, list[dict]] = {}
+    for row in res.fetchall():
+        groups.setdefault(row['content_hash'], []).append(row)
+    return list(groups.values())
+
+
+# Full-text search
+
+# Matches in the file name rank higher than matches elsewhere in its path
+SEARCH_RANK = "bm25(file_fts, 10.0, 1.0)"
+
+_SEARCH_TERM = re.compile(r'"([^"]*)"?|(\S+)')
+
+
+def match_expression(text: str) -> str:
+    """
+    Turn search input into an FTS5 query: bare words match as prefixes and
+    "quoted text" matches as a phrase. All terms must match. Raises
+    ValueError if there are no terms, which FTS5 would reject as a syntax error.
+    """
+    terms = []
+    for m in _SEARCH_TERM.finditer(text):
+        phrase, word = m.groups()
+        if phrase is not None:
+            if phrase.strip():
+                terms.append('"' + phrase.replace('"', '""') + '"')
+        else:
+            terms.append('"' + word.replace('"', '""') + '"*')
+    if not terms:
+        raise ValueError(f"no search terms in {text!r}")
+    return ' '.join(terms)
+
+
+def search_files(cur: sqlite3.Cursor, expression: str, library: Optional[str] = None,
+                 names_only: bool = False, limit: Optional[int] = None) -> list[dict]:
+    """Run an FTS5 `expression` over live files, best matches first."""
+    if names_only:
+        expression = f"name : ({expression})"
+
+    conditions = ["file_fts match ?"]
+    params = [expression]
+    if library is not None:
+        conditions.append("l.name = ?")
+        params.append(library)
+
+    sql = f"""
+        select l.name as library, f.path, f.size, f.mtime, {SEARCH_RANK} as rank
+        from file_fts
+        join file_path f on f.id = file_fts.rowid
+        join library l on l.id = f.library_id
+        where {' and '.join(conditions)}
+        order by rank
+    """
+    if limit is not None:
+        sql += " limit ?"
+        params.append(limit)
+
+    return cur.execute(sql, params).fetchall()
+
+
+# Snapshots
+#
+# A snapshot is gzip-compressed NDJSON: a header line, then each directory
+# of the library followed by its files, deleted ones included. Timestamps
+# are kept so that merging can tell which side saw a file last.
+
+SNAPSHOT_FORMAT = 1
+
+
+@dataclass
+class MergeStats:
+    dirs_added: int = 0
+    dirs_updated: int = 0
+    files_added: int = 0
+    files_updated: int = 0
+    files_deleted: int = 0
+    files_unchanged: int = 0
+    hashes_adopted: int = 0
+
+
+def open_snapshot(path: str, mode: str):
+    """Open a snapshot for reading ('r') or writing ('w'); '-' is stdin/stdout."""
+    if path == '-':
+        stream = sys.stdin.buffer if mode == 'r' else sys.stdout.buffer
+        return io.TextIOWrapper(gzip.GzipFile(fileobj=stream, mode=mode + 'b'), encoding='utf-8')
+    return gzip.open(path, mode + 't', encoding='utf-8')
+
+
+def _snapshot_line(row: dict) -> str:
+    return json.dumps({k: v for k, v in row.items() if v is not None}, separators=(',', ':'))
+
+
+def export_library(cur: sqlite3.Cursor, lib: Library, out) -> int:
+    """Write a snapshot of a library's index to `out`. Returns the number of files."""
+    header = {
+        'fsindex_snapshot': SNAPSHOT_FORMAT,
+        'library': {'name': lib.name, 'mount_path': lib.mount_path},
+        'exported_at': datetime.datetime.now(datetime.UTC).isoformat(),
+    }
+    print(json.dumps(header), file=out)
+
+    directories = cur.execute(
+        """
+        select id, path as directory, mtime, updated_at, deleted_at from directory
+        where library_id = ? order by path
+        """,
+        (lib.id,),
+    ).fetchall()
+
+    count = 0
+    for directory in directories:
+        print(_snapshot_line({k: v for k, v in directory.items() if k != 'id'}), file=out)
+        res = cur.execute(
+            f"""
+            select f.name, f.size, f.mtime, f.inode, f.updated_at, f.deleted_at,
+                h.partial_hash, h.content_hash
+            from file f
+            left join {VALID_HASH_JOIN}
+            where f.directory_id = ?
+            order by f.name
+            """,
+            (directory['id'],),
+        )
+        for row in res:
+            print(_snapshot_line(row), file=out)
+            count += 1
+
+    return count
+
+
+def read_snapshot(lines) -> tuple[dict, Iterator[tuple[dict, list[dict]]]]:
+    """Parse a snapshot into its header and a stream of (directory, files) pairs."""
+    lines = iter(lines)
+    header = json.loads(next(lines))
+    if header.get('fsindex_snapshot') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Not a supported fsindex snapshot: {header!r}")
+
+    def directories():
+        directory, files = None, []
+        for line in lines:
+            row = json.loads(line)
+            if 'directory' in row:
+                if directory is not None:
+                    yield directory, files
+                directory, files = row, []
+            else:
+                files.append(row)
+        if directory is not None:
+            yield directory, files
+
+    return header, directories()
+
+
+def _is_newer(theirs: dict, ours: dict) -> bool:
+    # Timestamps have one-second resolution: ties go to the snapshot
+    return theirs.get('updated_at', '') >= (ours['updated_at'] or '')
+
+
+def merge_snapshot(con: sqlite3.Connection, lib: Library,
+                   directories: Iterable[tuple[dict, list[dict]]],
+                   commit_size: int = DEFAULT_COMMIT_SIZE) -> MergeStats:
+    """
+    Merge snapshot directories into a local library without touching the disk.
+
+    Files are matched by path: the same (size, mtime) on both sides is the
+    same file, and only its hashes are taken over if missing locally.
+    Otherwise whichever side recorded the file last wins. A directory whose
+    snapshot is newer also takes the snapshot's mtime, and its local files
+    that the snapshot does not list are deleted, since that newer listing
+    did not see them.
+    """
+    cur = con.cursor()
+    stats = MergeStats()
+    uncommitted = 0
+
+    for theirs_dir, files in directories:
+        ours_dir = cur.execute(
+            "select id, mtime, updated_at, deleted_at from directory where library_id = ? and path = ?",
+            (lib.id, theirs_dir['directory']),
+        ).fetchone()
+
+        if ours_dir is None:
+            res = cur.execute(
+                """
+                insert into directory (library_id, path, mtime, updated_at, deleted_at)
+                values (?, ?, ?, ?, ?) returning id
+                """,
+                (lib.id, theirs_dir['directory'], theirs_dir.get('mtime'),
+                 theirs_dir.get('updated_at'), theirs_dir.get('deleted_at')),
+            )
+            directory_id = res.fetchone()['id']
+            newer_listing = True
+            stats.dirs_added += 1
+        else:
+            directory_id = ours_dir['id']
+            newer_listing = _is_newer(theirs_dir, ours_dir)
+            if newer_listing:
+                cur.execute(
+                    "update directory set mtime = ?, updated_at = ?, deleted_at = ? where id = ?",
+                    (theirs_dir.get('mtime'), theirs_dir.get('updated_at'),
+                     theirs_dir.get('deleted_at'), directory_id),
+                )
+                stats.dirs_updated += 1
+
+        ours_files = {
+            row['name']: row
+            for row in cur.execute(
+                f"""
+                select f.id, f.name, f.size, f.mtime, f.inode, f.updated_at, f.deleted_at,
+                    h.content_hash
+                from file f
+                left join {VALID_HASH_JOIN}
+                where f.directory_id = ?
+                """,
+                (directory_id,),
+            )
+        }
+
+        for theirs in files:
+            theirs = {
+                'partial_hash': None, 'content_hash': None, 'inode': None,
+                'updated_at': None, 'deleted_at': None,
+                **theirs,
+            }
+            ours = ours_files.pop(theirs['name'], None)
+
+            if ours is None:
+                res = cur.execute(
+                    """
+                    insert into file (library_id, directory_id, name, size, mtime, inode,
+                                      updated_at, deleted_at)
+                    values (:library_id, :directory_id, :name, :size, :mtime, :inode,
+                            :updated_at, :deleted_at)
+                    returning id
+                    """,
+                    {**theirs, 'library_id': lib.id, 'directory_id': directory_id},
+                )
+                file_id, inode = res.fetchone()['id'], theirs['inode']
+                stats.files_added += 1
+            elif (
+                (ours['size'], ours['mtime']) == (theirs['size'], theirs['mtime'])
+                and (ours['deleted_at'] is None) == (theirs['deleted_at'] is None)
+            ):
+                stats.files_unchanged += 1
+                if ours['content_hash'] is not None or theirs['partial_hash'] is None:
+                    continue
+                file_id, inode = ours['id'], ours['inode']
+            elif _is_newer(theirs, ours):
+                cur.execute(
+                    """
+                    update file set size = :size, mtime = :mtime, inode = :inode,
+                        updated_at = :updated_at, deleted_at = :deleted_at
+                    where id = :id
+                    """,
+                    {**theirs, 'id': ours['id']},
+                )
+                file_id, inode = ours['id'], theirs['inode']
+                if theirs['deleted_at'] is not None:
+                    stats.files_deleted += 1
+                else:
+                    stats.files_updated += 1
+            else:
+                continue
+
+            if theirs['partial_hash'] is not None:
+                cur.execute(
+                    """
+                    insert into file_hash (file_id, size, mtime, inode, partial_hash, content_hash)
+                    values (?, ?, ?, ?, ?, ?)
+                    on conflict (file_id) do update set
+                        size = excluded.size,
+                        mtime = excluded.mtime,
+                        inode = excluded.inode,
+                        partial_hash = excluded.partial_hash,
+                        content_hash = excluded.content_hash,
+                        updated_at = current_timestamp
+                    """,
+                    (file_id, theirs['size'], theirs['mtime'], inode,
+                     theirs['partial_hash'], theirs['content_hash']),
+                )
+                stats.hashes_adopted += 1
+
+        if newer_listing:
+            gone = [ours['id'] for ours in ours_files.values() if ours['deleted_at'] is None]
+            delete_files(cur, gone, theirs_dir.get('updated_at'))
+            stats.files_deleted += len(gone)
+
+        uncommitted += len(files) + 1
+        if uncommitted >= commit_size:
+            con.commit()
+            uncommitted = 0
+
+    con.commit()
+    return stats
 
 
 def list_tables(cur: sqlite3.Cursor) -> set[str]:
@@ -176,54 +1763,316 @@ def list_tables(cur: sqlite3.Cursor) -> set[str]:
     return {row['name'] for row in res.fetchall()}
 
 
-def main():
-    db_path = Path('~/Documents').expanduser() / 'fsindex.db'
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-
-    con = sqlite3.connect(db_path, autocommit=False)
+def connect(db_path: Path) -> sqlite3.Connection:
+    con = sqlite3.connect(db_path, autocommit=True)
+    con.execute("pragma journal_mode = wal")
+    con.autocommit = False
     con.row_factory = dict_factory
 
+    db_schemas.migrate(con.cursor())
+    return con
+
+
+def find_library(con: sqlite3.Connection, name: str, root: Path) -> Library:
     cur = con.cursor()
+    libraries = [l for l in list_libraries(cur) if l.mount_path == str(root)]
+    if libraries:
+        return libraries[0]
+
+    with con:
+        return add_library(cur, name, str(root))
+
+
+def cmd_scan(con: sqlite3.Connection, args: argparse.Namespace):
+    root = Path(args.root).expanduser()
+    lib = find_library(con, args.library, root)
+
+    tune_for_ingest(con, args.cache_mib)
+    try:
+        stats = scan_library(
+            con, lib, root,
+            full=args.full,
+            jobs=args.jobs,
+            batch_size=args.batch_size,
+            commit_size=args.commit_size,
+            progress=Progress() if args.progress else None,
+            allow_empty=args.allow_empty,
+        )
+    except LibraryRootChanged as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(stats)
+
+
+def cmd_runs(con: sqlite3.Connection, args: argparse.Namespace):
+    runs = list_scan_runs(con.cursor(), args.library, args.limit)
+
+    print(tabulate(
+        [
+            (
+                run['id'], run['library'], 'full' if run['full'] else 'incremental',
+                run['status'], run['started_at'], f"{run['elapsed']:.1f}s",
+                run['dirs_listed'], run['dirs_skipped'],
+                run['files_added'], run['files_updated'], run['files_deleted'],
+                f"{run['files_per_second']:.0f}" if run['files_per_second'] else '',
+            )
+            for run in runs
+        ],
+        headers=(
+            "ID", "LIBRARY", "KIND", "STATUS", "STARTED", "ELAPSED",
+            "LISTED", "SKIPPED", "ADDED", "UPDATED", "DELETED", "FILES/S",
+        ),
+        tablefmt="plain",
+    ))
 
-    db_schemas.migrate(cur)
 
-    # Check libraries
+def cmd_watch(con: sqlite3.Connection, args: argparse.Namespace):
+    root = Path(args.root).expanduser()
+    lib = find_library(con, args.library, root)
 
-    libname, root = sys.argv[1:3]
-    root = Path(root).expanduser()
+    watcher = LibraryWatcher(con, lib, root, settle=args.settle, max_delay=args.max_delay)
+    try:
+        watcher.run(on_change=print)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
 
-    libraries = list_libraries(cur)
-    libraries = [l for l in libraries if l.mount_path == str(root)]
-    print(libraries)
+
+def parse_since(value: str) -> datetime.datetime:
+    """Parse an ISO 8601 date/time; naive values are taken as local time."""
+    since = datetime.datetime.fromisoformat(value)
+    if since.tzinfo is None:
+        since = since.astimezone()
+    return since.astimezone(datetime.UTC)
+
+
+def cmd_query(con: sqlite3.Connection, args: argparse.Namespace):
+    query = FileQuery(
+        library=args.library,
+        name=args.name,
+        path=args.path,
+        since=args.since,
+        largest=args.largest,
+        limit=args.limit,
+    )
+    rows = find_files(con.cursor(), query)
+
+    print(tabulate(
+        [(row['size'], row['mtime'], row['library'], row['path']) for row in rows],
+        headers=("SIZE", "MTIME", "LIBRARY", "PATH"),
+        tablefmt="plain",
+    ))
+
+
+def cmd_search(con: sqlite3.Connection, args: argparse.Namespace):
+    text = ' '.join(args.terms)
+    try:
+        expression = text if args.raw else match_expression(text)
+    except ValueError as e:
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not expression.strip():
+        print("error: empty search expression", file=sys.stderr)
+        sys.exit(1)
+    try:
+        rows = search_files(con.cursor(), expression, args.library, args.names_only, args.limit)
+    except sqlite3.OperationalError as e:
+        # A malformed --raw expression, such as 'a AND'
+        print(f"error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(tabulate(
+        [(row['size'], row['mtime'], row['library'], row['path']) for row in rows],
+        headers=("SIZE", "MTIME", "LIBRARY", "PATH"),
+        tablefmt="plain",
+    ))
+
+
+def cmd_dupes(con: sqlite3.Connection, args: argparse.Namespace):
+    if not args.cached:
+        stats = hash_candidates(con, args.library, args.min_size, args.jobs)
+        print(stats, file=sys.stderr)
+
+    wasted = 0
+    for group in find_duplicates(con.cursor(), args.library, args.min_size):
+        size = group[0]['size']
+        wasted += size * (len(group) - 1)
+        print(f"{size} bytes x {len(group)}  {group[0]['content_hash'][:16]}")
+        for row in group:
+            print(f"  {row['library']}: {row['path']}")
+        print()
+
+    print(f"{wasted} bytes in duplicate copies")
+
+
+def cmd_export(con: sqlite3.Connection, args: argparse.Namespace):
+    cur = con.cursor()
+    libraries = [l for l in list_libraries(cur) if l.name == args.library]
     if not libraries:
-        with con:
-            lib = add_library(cur, libname, str(root))
-    else:
-        lib = libraries[0]
+        print(f"error: no library named {args.library!r}", file=sys.stderr)
+        sys.exit(1)
 
-    # Main loop
+    with open_snapshot(args.output, 'w') as out:
+        count = export_library(cur, libraries[0], out)
+    print(f"exported {count} files", file=sys.stderr)
 
-    with con:
-        for dirpath, dirnames, filenames in root.walk():
-            fulldirpath = Path(dirpath)
-            dirname = fulldirpath.relative_to(root)
 
-            for filename in filenames:
-                entry = dirname / filename
-                stat = (fulldirpath / filename).stat(follow_symlinks=False)
-                mtime = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.UTC)
+def cmd_import(con: sqlite3.Connection, args: argparse.Namespace):
+    with open_snapshot(args.snapshot, 'r') as snapshot:
+        header, directories = read_snapshot(snapshot)
 
-                fileinfo = File(
-                    path=entry,
-                    size=stat.st_size,
-                    mtime=mtime,
-                )
-                print(fileinfo)
-                add_file(cur, lib.id, fileinfo)
+        name = args.library or header['library']['name']
+        mount_path = args.mount_path or header['library']['mount_path']
+        libraries = [l for l in list_libraries(con.cursor()) if l.name == name]
+        if libraries:
+            lib = libraries[0]
+        else:
+            with con:
+                lib = add_library(con.cursor(), name, mount_path)
+
+        stats = merge_snapshot(con, lib, directories)
+    print(stats, file=sys.stderr)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Index files of a library into a SQLite database')
+    parser.add_argument(
+        '--db', type=Path, default=Path('~/Documents/fsindex.db'),
+        help='index database (default: %(default)s)',
+    )
+    subparsers = parser.add_subparsers(required=True)
+
+    scan = subparsers.add_parser('scan', help='scan a library and update its index')
+    scan.set_defaults(handler=cmd_scan)
+    scan.add_argument('library', help='library name, used when it is first indexed')
+    scan.add_argument('root', help='library root directory')
+    scan.add_argument(
+        '--full', action='store_true',
+        help='list every directory, even those whose mtime is unchanged',
+    )
+    scan.add_argument(
+        '-j', '--jobs', type=int, default=DEFAULT_JOBS, metavar='N',
+        help='directories listed in parallel (default: %(default)s)',
+    )
+    scan.add_argument(
+        '--batch-size', type=int, default=DEFAULT_BATCH_SIZE, metavar='N',
+        help='rows per executemany batch (default: %(default)s)',
+    )
+    scan.add_argument(
+        '--commit-size', type=int, default=DEFAULT_COMMIT_SIZE, metavar='N',
+        help='rows per transaction (default: %(default)s)',
+    )
+    scan.add_argument(
+        '--cache-mib', type=int, default=DEFAULT_CACHE_MIB, metavar='MIB',
+        help='SQLite page cache size during the scan (default: %(default)s)',
+    )
+    scan.add_argument('--progress', action='store_true', help='show a progress meter')
+    scan.add_argument(
+        '--allow-empty', action='store_true',
+        help='scan an empty root even if files were indexed, marking them all deleted',
+    )
+
+    runs = subparsers.add_parser('runs', help='show recent scans')
+    runs.set_defaults(handler=cmd_runs)
+    runs.add_argument('-l', '--library', help='only scans of this library')
+    runs.add_argument(
+        '-n', '--limit', type=int, default=20, metavar='N',
+        help='show at most N scans (default: %(default)s)',
+    )
+
+    watch = subparsers.add_parser('watch', help='keep the index of a library live')
+    watch.set_defaults(handler=cmd_watch)
+    watch.add_argument('library', help='library name, used when it is first indexed')
+    watch.add_argument('root', help='library root directory')
+    watch.add_argument(
+        '--settle', type=float, default=0.5, metavar='SECONDS',
+        help='apply changes once no events came for this long (default: %(default)s)',
+    )
+    watch.add_argument(
+        '--max-delay', type=float, default=5.0, metavar='SECONDS',
+        help='apply changes at least this often during bursts (default: %(default)s)',
+    )
+
+    query = subparsers.add_parser('query', help='look up indexed files')
+    query.set_defaults(handler=cmd_query)
+    query.add_argument('-l', '--library', help='only files from this library')
+    query.add_argument('--name', metavar='GLOB', help='file name matches GLOB (case-sensitive)')
+    query.add_argument('--path', metavar='GLOB', help='relative path matches GLOB (case-sensitive)')
+    query.add_argument(
+        '--since', type=parse_since, metavar='DATE',
+        help='modified at or after DATE (ISO 8601, local time unless given); newest first',
+    )
+    query.add_argument('--largest', action='store_true', help='largest files first')
+    query.add_argument('-n', '--limit', type=int, metavar='N', help='show at most N files')
 
-    # End
+    search = subparsers.add_parser('search', help='full-text search over file names and paths')
+    search.set_defaults(handler=cmd_search)
+    search.add_argument(
+        'terms', nargs='+',
+        help='words match as prefixes, "quoted text" as a phrase; all must match',
+    )
+    search.add_argument('-l', '--library', help='only files from this library')
+    search.add_argument('--names-only', action='store_true', help="don't match directory names")
+    search.add_argument('--raw', action='store_true', help='terms are an FTS5 query expression')
+    search.add_argument(
+        '-n', '--limit', type=int, default=50, metavar='N',
+        help='show at most N files (default: %(default)s)',
+    )
+
+    export = subparsers.add_parser('export', help="write a snapshot of a library's index")
+    export.set_defaults(handler=cmd_export)
+    export.add_argument('library', help='library name')
+    export.add_argument(
+        '-o', '--output', default='-', metavar='FILE',
+        help='gzip-compressed NDJSON snapshot (default: standard output)',
+    )
+
+    import_ = subparsers.add_parser('import', help='merge a snapshot into the index')
+    import_.set_defaults(handler=cmd_import)
+    import_.add_argument('snapshot', help="snapshot file, or '-' for standard input")
+    import_.add_argument(
+        '-l', '--library',
+        help='merge into this library (default: the name in the snapshot)',
+    )
+    import_.add_argument(
+        '--mount-path', metavar='PATH',
+        help='where the library is mounted on this host, if it is new here',
+    )
+
+    dupes = subparsers.add_parser('dupes', help='hash same-size files and report duplicates')
+    dupes.set_defaults(handler=cmd_dupes)
+    dupes.add_argument(
+        '-l', '--library', action='append',
+        help='only files from this library (repeatable; default: all libraries)',
+    )
+    dupes.add_argument(
+        '--min-size', type=int, default=1, metavar='BYTES',
+        help='ignore files smaller than this (default: %(default)s)',
+    )
+    dupes.add_argument(
+        '-j', '--jobs', type=int, metavar='N',
+        help='hashing processes (default: number of CPUs)',
+    )
+    dupes.add_argument(
+        '--cached', action='store_true',
+        help="report from stored hashes only, don't read any file",
+    )
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    db_path = args.db.expanduser()
+    db_path.parent.mkdir(parents=True, exist_ok=True)
 
-    con.close()
+    con = connect(db_path)
+    try:
+        args.handler(con, args)
+    finally:
+        con.close()
 
 
 if __name__ == '__main__':
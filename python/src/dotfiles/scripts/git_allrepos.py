@@ -1,15 +1,192 @@
 #!/usr/bin/env python3
 
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+import json
 import os
+import stat
 import subprocess
 
+from xdg_base_dirs import xdg_cache_home
+
+from dotfiles.git.repo import GitDirs, REPO, SUBMODULE, classify_repo, read_config, UnsupportedLayout
+
+# Directories that hold dependencies, not checkouts of their own
+DEFAULT_PRUNE = ('node_modules', 'vendor', '.venv', '__pycache__')
+
 def is_git_repo(entry):
-    from os.path import join, isdir
-    return isdir(entry) and isdir(join(entry, '.git'))
+    return os.path.isdir(entry) and classify_repo(Path(entry)) is not None
 
 class ProcessUncleanExit(Exception): pass
 
+class DiscoveryCache:
+    """
+    Directory listings from previous scans, kept under the XDG cache dir and
+    shared by the tools that look for repositories.
+
+    Each scanned directory maps to its subdirectories, with their mtimes and
+    their kind and git dirs if they are repositories. A listing is reused while
+    the directory and the subdirectories keep their mtimes: creating or
+    removing `.git` changes the mtime of the directory that holds it.
+    """
+
+    VERSION = 2
+
+    def __init__(self, path: Optional[Path] = None, prune: Iterable[str] = DEFAULT_PRUNE):
+        self.path = path or xdg_cache_home() / 'dotfiles' / 'git-repos.json'
+        self.prune = list(prune)
+        self.dirs: dict[str, dict] = {}
+
+    def load(self) -> 'DiscoveryCache':
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return self
+        # Listings leave out pruned entries, so they only hold for the same patterns
+        if data.get('version') == self.VERSION and data.get('prune') == self.prune:
+            self.dirs = data['dirs']
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.VERSION, 'prune': self.prune, 'dirs': self.dirs}, f)
+        tmp.replace(self.path)
+
+def mtime_of(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def classify_child(path: str) -> Optional[GitDirs]:
+    """classify_repo, with a single stat for the usual cases: a plain repository or no repository."""
+    try:
+        dotgit = os.stat(os.path.join(path, '.git'))
+    except FileNotFoundError:
+        dotgit = None
+    except OSError:
+        return None
+
+    if dotgit is not None and stat.S_ISDIR(dotgit.st_mode):
+        git_dir = Path(path, '.git')
+        return GitDirs(worktree=Path(path), git_dir=git_dir, common_dir=git_dir, kind=REPO)
+    if dotgit is None and not os.path.isfile(os.path.join(path, 'HEAD')):
+        return None
+    try:
+        return classify_repo(Path(path))
+    except OSError:
+        return None
+
+def list_directory(path: str, prune: Iterable[str]) -> Optional[dict]:
+    """
+    List the subdirectories of `path` as [realpath, mtime, kind, git_dir,
+    common_dir], leaving out those matching a `prune` pattern. The last three
+    are None for directories that are not repositories. None if `path` can't
+    be read.
+    """
+    mtime = mtime_of(path)
+    children = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if any(fnmatch(entry.name, pattern) for pattern in prune):
+                    continue
+                try:
+                    if not entry.is_dir():
+                        continue
+                    child = os.path.realpath(entry.path) if entry.is_symlink() else entry.path
+                    child_mtime = os.stat(child).st_mtime_ns
+                except OSError:
+                    continue
+                dirs = classify_child(child)
+                if dirs is None:
+                    children.append([child, child_mtime, None, None, None])
+                else:
+                    children.append([child, child_mtime, dirs.kind, str(dirs.git_dir), str(dirs.common_dir)])
+    except OSError:
+        return None
+
+    return {'mtime': mtime, 'children': children}
+
+def cached_listing(path: str, cached: Optional[dict]) -> bool:
+    return (
+        cached is not None
+        and cached['mtime'] == mtime_of(path)
+        and all(mtime_of(child) == child_mtime for child, child_mtime, *_ in cached['children'])
+    )
+
+def find_submodules(repo: GitDirs) -> Iterator[GitDirs]:
+    """Yield the checked out submodules of `repo`, and theirs, from its .gitmodules."""
+    if repo.worktree is None:
+        return
+    try:
+        config = read_config(repo.worktree / '.gitmodules')
+    except (UnsupportedLayout, OSError):
+        return
+
+    for key, values in config.items():
+        if not (key.startswith('submodule.') and key.endswith('.path')):
+            continue
+        dirs = classify_repo(repo.worktree / values[-1])
+        if dirs is not None:
+            # Old style submodules have a .git directory of their own
+            dirs.kind = SUBMODULE
+            yield dirs
+            yield from find_submodules(dirs)
+
+def discover(root: str, max_depth: int = 0, jobs: Optional[int] = None,
+             cache: Optional[DiscoveryCache] = None, submodules: bool = False) -> Iterator[GitDirs]:
+    """
+    Yield the repositories under `root`, looking up to `max_depth` levels
+    below its children. Repositories are not searched for nested ones, except
+    for their submodules if `submodules` is set. Each level is listed with up
+    to `jobs` threads. Directories matching the prune patterns of `cache`
+    (DEFAULT_PRUNE without a cache) are skipped.
+    """
+    prune = cache.prune if cache is not None else DEFAULT_PRUNE
+
+    def scan(path: str) -> Optional[dict]:
+        cached = cache.dirs.get(path) if cache is not None else None
+        if cached_listing(path, cached):
+            return cached
+        return list_directory(path, prune)
+
+    root = os.path.realpath(root)
+    if not os.path.isdir(root):
+        raise NotADirectoryError(root)
+
+    frontier = [root]
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for depth in range(max_depth, -1, -1):
+            next_frontier = []
+            for path, listing in zip(frontier, pool.map(scan, frontier)):
+                if listing is None:
+                    continue
+                if cache is not None:
+                    cache.dirs[path] = listing
+
+                for child, _, kind, git_dir, common_dir in listing['children']:
+                    if kind is not None:
+                        worktree = None if git_dir == child else Path(child)
+                        repo = GitDirs(worktree, Path(git_dir), Path(common_dir), kind)
+                        yield repo
+                        if submodules:
+                            yield from find_submodules(repo)
+                    elif depth > 0:
+                        next_frontier.append(child)
+            frontier = next_frontier
+
+def discover_repos(root: str, max_depth: int = 0, **kwargs) -> Iterator[str]:
+    """Yield the real paths of the repositories found by `discover`: worktrees, or git dirs of bare ones."""
+    for repo in discover(root, max_depth, **kwargs):
+        yield str(repo.path)
+
 def parse():
     parser = ArgumentParser()
 
@@ -21,6 +198,30 @@ def parse():
         '--null', '-0', action='store_true', dest='null_separator',
         help='separate entries by NUL (\\0) instead of newline'
     )
+    parser.add_argument(
+        '--prune', action='append', default=[], metavar='PATTERN',
+        help='skip directories whose name matches PATTERN (can be repeated)'
+    )
+    parser.add_argument(
+        '--no-default-prune', action='store_false', dest='default_prune',
+        help=f'also look into {", ".join(DEFAULT_PRUNE)}'
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=None, metavar='N',
+        help='list up to N directories at once'
+    )
+    parser.add_argument(
+        '--submodules', action='store_true',
+        help='also list the submodules of each repository'
+    )
+    parser.add_argument(
+        '--long', '-l', action='store_true',
+        help='print the kind of each repository (repo, worktree, submodule, bare) and its common git dir'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_false', dest='cache',
+        help='list every directory instead of reusing unchanged listings from previous runs'
+    )
 
     parser.add_argument(
         'directories', nargs='*', default=['.'], metavar='DIR',
@@ -30,31 +231,33 @@ def parse():
     args = parser.parse_args()
     return args
 
-def candidates_from(root, max_depth=0):
-    from os.path import realpath, join, isdir
+def find_child_repos(root, max_depth, **kwargs):
+    return sorted(discover_repos(root, max_depth, **kwargs))
 
-    for d in os.listdir(root):
-        d = realpath(join(root, d))
-
-        if is_git_repo(d):
-            yield d
-
-        elif max_depth > 0 and isdir(d):
-            yield from candidates_from(d, max_depth - 1)
-
-def find_child_repos(root, max_depth):
-    return sorted(candidates_from(root, max_depth))
+def find_repos(root, max_depth, **kwargs) -> list[GitDirs]:
+    return sorted(discover(root, max_depth, **kwargs), key=lambda repo: repo.path)
 
 def main():
     try:
         args = parse()
         separator = '\0' if args.null_separator else '\n'
+        prune = [*(DEFAULT_PRUNE if args.default_prune else ()), *args.prune]
+
+        cache = DiscoveryCache(prune=prune)
+        if args.cache:
+            cache.load()
 
         for root in args.directories:
-            dirs = find_child_repos(root, args.depth)
+            repos = find_repos(root, args.depth, jobs=args.jobs, cache=cache,
+                               submodules=args.submodules)
+
+            for repo in repos:
+                if args.long:
+                    print(repo.path, repo.kind, repo.common_dir, sep='\t', end=separator)
+                else:
+                    print(repo.path, end=separator)
 
-            for subdir in dirs:
-                print(subdir, end=separator)
+        cache.save()
     except KeyboardInterrupt:
         pass
 
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 
-import os, sys, re, subprocess, argparse
+import os, sys, re, subprocess, argparse, json, shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from dataclasses import dataclass
-from typing import Optional, List, Tuple, Iterable
+from dataclasses import dataclass, asdict, field
+from typing import Optional, List, Tuple, Iterable, TextIO, Callable
 from tabulate import tabulate
-from itertools import chain
+from xdg_base_dirs import xdg_cache_home
+from dotfiles.git.repo import (
+    find_git_dirs, read_config, read_head, read_branch_info, shorten_ref, tracking_ref, UnsupportedLayout,
+)
 from dotfiles.scripts import git_allrepos
 
 CONFIG_NAME = 'repo-roots.default'
 
+DEFAULT_TIMEOUT = 10.0
+
 def get_repo_roots() -> List[Path]:
     cmd = subprocess.run(['git', 'config', CONFIG_NAME], capture_output=True, text=True)
 
@@ -19,6 +25,17 @@ def get_repo_roots() -> List[Path]:
         if line
     ]
 
+@dataclass
+class BranchSync:
+    name: str
+    upstream: Optional[str]
+    ahead: int
+    behind: int
+    gone: bool
+
+    def is_out_of_sync(self) -> bool:
+        return self.upstream is not None and (self.gone or self.ahead > 0 or self.behind > 0)
+
 @dataclass
 class BranchReport:
     repo: Path
@@ -28,6 +45,8 @@ class BranchReport:
     behind: int
     gone: bool
     uncommitted_changes: bool
+    # Every local branch, the checked out one included; only filled by --sync-only
+    branches: List[BranchSync] = field(default_factory=list)
 
     def __lt__(self, other):
         if isinstance(other, BranchReport):
@@ -49,12 +68,33 @@ class BranchReport:
             and self.branch in ('main', 'master')  # TODO
         )
 
+    def other_branches_out_of_sync(self) -> List[BranchSync]:
+        return [b for b in self.branches if b.name != self.branch and b.is_out_of_sync()]
+
     def is_changed(self) -> bool:
         return (
             self.uncommitted_changes
             or not self.is_in_sync_with_upstream()
             or not self.is_default_branch()
+            or bool(self.other_branches_out_of_sync())
+        )
+
+    def score(self) -> int:
+        commits = self.ahead + self.behind + sum(
+            b.ahead + b.behind for b in self.other_branches_out_of_sync()
         )
+        return 100 * commits + (1 if self.uncommitted_changes else 0)
+
+    def to_dict(self) -> dict:
+        return {**asdict(self), 'repo': str(self.repo)}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'BranchReport':
+        return cls(**{
+            **data,
+            'repo': Path(data['repo']),
+            'branches': [BranchSync(**b) for b in data.get('branches', [])],
+        })
 
 class PorcelainV2Parser:
 
@@ -112,6 +152,45 @@ class PorcelainV2Parser:
             uncommitted_changes=uncommitted_changes,
         )
 
+class ForEachRefParser:
+    """Parse the output of `git for-each-ref` with FORMAT, one line per local branch."""
+
+    FORMAT = '%(HEAD)%00%(refname:short)%00%(upstream:short)%00%(upstream:track)'
+
+    TRACK_PATTERN = re.compile(r"(ahead|behind) (\d+)")
+
+    def loads(self, data: str, repo: Path) -> BranchReport:
+        branches = []
+        head = None
+        for line in data.splitlines():
+            current, name, upstream, track = line.split('\0')
+            counts = dict(self.TRACK_PATTERN.findall(track))
+            branch = BranchSync(
+                name=name,
+                upstream=upstream or None,
+                ahead=int(counts.get('ahead', 0)),
+                behind=int(counts.get('behind', 0)),
+                gone=track == '[gone]',
+            )
+            branches.append(branch)
+            if current == '*':
+                head = branch
+
+        if head is None:
+            # Detached, or no commits yet
+            head = BranchSync('(detached)', None, 0, 0, False)
+
+        return BranchReport(
+            repo=repo,
+            branch=head.name,
+            upstream=head.upstream,
+            ahead=head.ahead,
+            behind=head.behind,
+            gone=head.gone,
+            uncommitted_changes=False,
+            branches=branches,
+        )
+
 @dataclass
 class EscapeFormat:
     on: str
@@ -139,6 +218,386 @@ def format_indicator(text: str, style: str) -> str:
     return styles[style](text)
 
 
+TABLE_HEADER = ("NAME", "BRANCH", "STATUS")
+
+
+def format_row(r: BranchReport) -> Tuple[str, str, str]:
+    branch_msg = r.branch
+    if r.upstream:
+        upstream = r.upstream
+        if upstream.endswith('/' + r.branch):
+            remote_name = r.upstream[:-len(r.branch)-1]
+            upstream = f' ↙{remote_name}'
+        else:
+            upstream = '...' + r.upstream
+
+        branch_msg += upstream
+
+    indicators = []
+    if r.ahead > 0:
+        indicators.append(format_indicator(f'↑{r.ahead}', 'ahead'))
+    if r.behind > 0:
+        indicators.append(format_indicator(f'↓{r.behind}', 'behind'))
+    if r.gone:
+        indicators.append(format_indicator('gone', 'gone'))
+    if r.uncommitted_changes:
+        indicators.append(format_indicator('*', 'uncommitted'))
+    for b in r.other_branches_out_of_sync():
+        if b.gone:
+            indicators.append(f'{b.name}:' + format_indicator('gone', 'gone'))
+            continue
+        counts = ''
+        if b.ahead > 0:
+            counts += format_indicator(f'↑{b.ahead}', 'ahead')
+        if b.behind > 0:
+            counts += format_indicator(f'↓{b.behind}', 'behind')
+        indicators.append(f'{b.name}:{counts}')
+
+    return r.repo.name, branch_msg, ' '.join(indicators)
+
+
+def format_table(reports: Iterable[BranchReport]) -> str:
+    return tabulate(
+        [TABLE_HEADER, *map(format_row, reports)],
+        headers="firstrow",
+        tablefmt="plain",
+    )
+
+
+class TableOutput:
+    """
+    Print one table, most out of sync repositories first, once all reports are
+    in. Errors come before it, sorted by repository, so the output doesn't
+    depend on which status finished first.
+    """
+
+    def __init__(self, file: TextIO = sys.stdout):
+        self.file = file
+        self.reports: List[BranchReport] = []
+        self.errors: List[Tuple[Path, str, tuple]] = []
+
+    def add(self, report: BranchReport):
+        self.reports.append(report)
+
+    def error(self, repo: Path, kind: str, *details):
+        self.errors.append((repo, kind, details))
+
+    def sorted_reports(self) -> List[BranchReport]:
+        return sorted(self.reports, key=lambda r: (r.score(), r), reverse=True)
+
+    def close(self):
+        for repo, kind, details in sorted(self.errors, key=lambda e: e[:2]):
+            print(kind, repo, *details, file=self.file)
+        print(format_table(self.sorted_reports()), file=self.file)
+
+
+class StreamOutput:
+    """
+    Print each row as soon as its report arrives. The name column is as wide
+    as the longest repository name, the branch column widens as needed.
+    """
+
+    def __init__(self, repos: Iterable[Path], file: TextIO = sys.stdout):
+        self.file = file
+        self.widths = [
+            max((len(repo.name) for repo in repos), default=0),
+            0,
+        ]
+        self.header_printed = False
+
+    def print_row(self, row: Tuple[str, str, str]):
+        self.widths = [max(w, len(col)) for w, col in zip(self.widths, row)]
+        name, branch, status = row
+        line = f'{name:<{self.widths[0]}}  {branch:<{self.widths[1]}}  {status}'
+        print(line.rstrip(), file=self.file, flush=True)
+
+    def add(self, report: BranchReport):
+        if not self.header_printed:
+            self.print_row(TABLE_HEADER)
+            self.header_printed = True
+        self.print_row(format_row(report))
+
+    def error(self, repo: Path, kind: str, *details):
+        print(kind, repo, *details, file=sys.stderr, flush=True)
+
+    def close(self):
+        pass
+
+
+class NdjsonOutput:
+    """Print one JSON object per line as reports arrive, for piping into other tools."""
+
+    def __init__(self, file: TextIO = sys.stdout):
+        self.file = file
+
+    def add(self, report: BranchReport):
+        data = {**report.to_dict(), 'score': report.score(), 'changed': report.is_changed()}
+        print(json.dumps(data), file=self.file, flush=True)
+
+    def error(self, repo: Path, kind: str, *details):
+        data = {'repo': str(repo), 'error': kind.lower()}
+        print(json.dumps(data), file=self.file, flush=True)
+
+    def close(self):
+        pass
+
+
+class LiveOutput(TableOutput):
+    """
+    Redraw the sorted table in place each time a report arrives. Only as many
+    rows as fit the terminal are shown until the end, when the whole table is
+    printed.
+    """
+
+    def __init__(self, file: TextIO = sys.stdout):
+        super().__init__(file)
+        self.errors: List[str] = []
+        self.drawn_lines = 0
+
+    def add(self, report: BranchReport):
+        super().add(report)
+        self.redraw(shutil.get_terminal_size().lines)
+
+    def error(self, repo: Path, kind: str, *details):
+        self.errors.append(' '.join(map(str, (kind, repo, *details))))
+        self.redraw(shutil.get_terminal_size().lines)
+
+    def redraw(self, max_rows: Optional[int] = None):
+        reports = self.sorted_reports()
+        errors = self.errors
+
+        if max_rows is not None:
+            # Leave room for the header, the "more" line and the cursor
+            fit = max(max_rows - len(errors) - 3, 0)
+            hidden = len(reports) - fit
+            if hidden > 0:
+                reports = reports[:fit]
+                errors = [*errors, f'... {hidden} more']
+
+        lines = [*errors, *format_table(reports).splitlines()]
+
+        if self.drawn_lines:
+            # Back to the start of the previous drawing, then clear it
+            self.file.write(f'\033[{self.drawn_lines}F\033[J')
+        self.file.write(''.join(line + '\n' for line in lines))
+        self.file.flush()
+        self.drawn_lines = len(lines)
+
+    def close(self):
+        self.redraw()
+
+
+class StatusCache:
+    """
+    The last BranchReport of each repository, kept under the XDG cache dir.
+
+    A report is reused while the files it was derived from keep their mtime
+    and size: the index, HEAD, config, packed-refs, the checked out branch
+    ref and its upstream ref. Editing a tracked file touches none of them,
+    so such changes only show up once the index changes (or with --refresh).
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = path or xdg_cache_home() / 'dotfiles' / 'git-modified.json'
+        self.entries: dict[str, dict] = {}
+
+    def load(self) -> 'StatusCache':
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+        return self
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        tmp.replace(self.path)
+
+    @staticmethod
+    def key(repo: Path) -> Optional[list]:
+        """None when the repo can't be cached: not found, or a config read_config can't follow."""
+        dirs = find_git_dirs(repo)
+        if dirs is None:
+            return None
+        try:
+            config = read_config(dirs.common_dir / 'config')
+        except (UnsupportedLayout, OSError):
+            return None
+
+        files = [
+            dirs.git_dir / 'index',
+            dirs.git_dir / 'HEAD',
+            dirs.common_dir / 'config',
+            dirs.common_dir / 'packed-refs',
+        ]
+        if (head := read_head(dirs)) is not None:
+            files.append(dirs.common_dir / head)
+            # Under refs/remotes/, or refs/heads/ for a local upstream
+            if (tracking := tracking_ref(config, shorten_ref(head))) is not None:
+                files.append(dirs.common_dir / tracking)
+
+        key = []
+        for path in files:
+            try:
+                st = path.stat()
+                key.append([str(path), st.st_mtime_ns, st.st_size])
+            except FileNotFoundError:
+                key.append([str(path), None, None])
+        return key
+
+    def lookup(self, repo: Path) -> tuple[Optional[BranchReport], Optional[list]]:
+        """Return the cached report if it is still fresh, and the current key to store a new one."""
+        entry = self.entries.get(str(repo))
+        key = self.key(repo)
+
+        if entry is None or key is None or entry['key'] != key:
+            return None, key
+
+        return BranchReport.from_dict(entry['report']), key
+
+    def store(self, repo: Path, key: Optional[list], report: BranchReport):
+        if key is None:
+            return
+        self.entries[str(repo)] = {
+            'key': key,
+            'report': report.to_dict(),
+        }
+
+
+@dataclass
+class StatusResult:
+    repo: Path
+    stdout: Optional[str]
+    timed_out: bool = False
+    # Set when the report did not come from parsing git status (cache or fast path)
+    report: Optional[BranchReport] = None
+    cache_key: Optional[list] = None
+
+
+def run_status(repo: Path, timeout: Optional[float] = None) -> StatusResult:
+    proc = subprocess.Popen(
+        ['git', 'status', '--porcelain=v2', '--branch'],
+        cwd=repo,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        stdout, _ = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        try:
+            proc.communicate(timeout=1)
+        except subprocess.TimeoutExpired:
+            # Stuck in the kernel (e.g. a dead NFS mount): leave it behind
+            pass
+        return StatusResult(repo, None, timed_out=True)
+
+    return StatusResult(repo, stdout)
+
+
+def count_ahead_behind(repo: Path, upstream: str,
+                       timeout: Optional[float] = None) -> Optional[Tuple[int, int]]:
+    try:
+        cmd = subprocess.run(
+            ['git', 'rev-list', '--left-right', '--count', f'HEAD...{upstream}'],
+            cwd=repo, capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+    if cmd.returncode != 0:
+        return None
+    ahead, behind = cmd.stdout.split()
+    return int(ahead), int(behind)
+
+
+def sync_status(repo: Path, timeout: Optional[float] = None) -> StatusResult:
+    """
+    Report the upstream sync state of every local branch with one
+    `git for-each-ref`, without looking at the worktree.
+    """
+    try:
+        cmd = subprocess.run(
+            ['git', 'for-each-ref', f'--format={ForEachRefParser.FORMAT}', 'refs/heads'],
+            cwd=repo, capture_output=True, text=True, timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return StatusResult(repo, None, timed_out=True)
+    if cmd.returncode != 0:
+        return StatusResult(repo, None)
+
+    return StatusResult(repo, cmd.stdout, report=ForEachRefParser().loads(cmd.stdout, repo))
+
+
+def fast_status(repo: Path, timeout: Optional[float] = None) -> StatusResult:
+    """
+    Build the report from the files in the git dir without running git, when
+    possible. Uncommitted changes are not checked. Git only runs to count
+    commits when the branch and its upstream differ, and does the whole job
+    when the repository uses something the readers don't handle (reftable,
+    config includes).
+    """
+    dirs = find_git_dirs(repo)
+    if dirs is None:
+        return run_status(repo, timeout)
+    try:
+        info = read_branch_info(dirs)
+    except (UnsupportedLayout, OSError, ValueError):
+        return run_status(repo, timeout)
+
+    ahead = behind = 0
+    if info.upstream_commit is not None and info.upstream_commit != info.commit:
+        counts = count_ahead_behind(repo, info.upstream_commit, timeout)
+        if counts is None:
+            return run_status(repo, timeout)
+        ahead, behind = counts
+
+    return StatusResult(repo, None, report=BranchReport(
+        repo=repo,
+        branch=info.branch if info.branch is not None else '(detached)',
+        upstream=info.upstream,
+        ahead=ahead,
+        behind=behind,
+        gone=info.upstream is not None and info.upstream_commit is None,
+        uncommitted_changes=False,
+    ))
+
+
+def collect_statuses(repos: Iterable[Path], jobs: Optional[int] = None,
+                     timeout: Optional[float] = DEFAULT_TIMEOUT,
+                     cache: Optional[StatusCache] = None,
+                     ordered: bool = True,
+                     runner: Callable[[Path, Optional[float]], StatusResult] = run_status,
+                     ) -> Iterable[StatusResult]:
+    """
+    Run `git status` (or `runner`) in up to `jobs` repositories at once,
+    skipping those with a fresh entry in `cache`. Results keep the order of
+    `repos`, unless `ordered` is false: then they come as soon as they are ready.
+    """
+    def status(repo: Path) -> StatusResult:
+        if cache is None:
+            return runner(repo, timeout)
+
+        cached, key = cache.lookup(repo)
+        if cached is not None:
+            return StatusResult(repo, None, report=cached, cache_key=key)
+
+        result = runner(repo, timeout)
+        result.cache_key = key
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        if ordered:
+            yield from pool.map(status, repos)
+        else:
+            futures = [pool.submit(status, repo) for repo in repos]
+            for future in as_completed(futures):
+                yield future.result()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -157,6 +616,50 @@ def main():
             the main branch, or where it is out of sync from its upstream branch.
         """
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=os.cpu_count(), metavar='N',
+        help='run up to N git processes at once (default: number of CPUs)',
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT, metavar='SECONDS',
+        help='give up on a repository after this long (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help="""
+            Look for repositories and run git status in every one of them instead
+            of reusing cached results. Cached results are reused while the index,
+            HEAD and branch refs are unchanged, so edits to tracked files may not
+            show up without this.
+        """
+    )
+    parser.add_argument(
+        '-o', '--output', choices=('table', 'stream', 'live', 'ndjson'), default='table',
+        help="""
+            table: print a table sorted by how far out of sync each repository is,
+            once all are checked (default).
+            stream: print rows as each repository is checked.
+            live: keep redrawing the sorted table as repositories are checked
+            (table when not writing to a terminal).
+            ndjson: print a JSON object per repository as it is checked.
+        """
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--fast', action='store_true',
+        help="""
+            Skip the check for uncommitted changes and read branches and upstreams
+            from the .git directory, running git only to count commits on branches
+            that differ from their upstream.
+        """
+    )
+    mode.add_argument(
+        '--sync-only', action='store_true',
+        help="""
+            Skip the check for uncommitted changes and report how every local
+            branch is in sync with its upstream, not just the checked out one.
+        """
+    )
     args = parser.parse_args()
 
     root_dirs = args.root_dirs or get_repo_roots()
@@ -167,62 +670,61 @@ def main():
         )
         sys.exit(1)
 
-    repos = chain.from_iterable(
-        git_allrepos.find_child_repos(root_dir, max_depth=0)
+    discovery = git_allrepos.DiscoveryCache()
+    if not args.refresh:
+        discovery.load()
+    repos = [
+        repo.worktree
         for root_dir in root_dirs
-    )
+        for repo in git_allrepos.find_repos(root_dir, max_depth=0, cache=discovery)
+        # Bare repositories have nothing to report
+        if repo.worktree is not None
+    ]
+    discovery.save()
+
+    if args.output == 'live' and not sys.stdout.isatty():
+        args.output = 'table'
+    output = {
+        'table': lambda: TableOutput(),
+        'stream': lambda: StreamOutput(repos),
+        'live': lambda: LiveOutput(),
+        'ndjson': lambda: NdjsonOutput(),
+    }[args.output]()
+
+    if args.fast:
+        runner = fast_status
+    elif args.sync_only:
+        runner = sync_status
+    else:
+        runner = run_status
+
+    # The cache key only covers the checked out branch
+    cache = StatusCache() if runner is run_status else None
+    if cache is not None and not args.refresh:
+        cache.load()
 
     parser = PorcelainV2Parser()
-    results = []
-    for repo_dir in repos:
-        repo_dir = Path(repo_dir)
-        cmd = subprocess.run(['git', 'status', '--porcelain=v2', '--branch'], cwd=repo_dir, capture_output=True, text=True)
+    statuses = collect_statuses(repos, args.jobs, args.timeout, cache, ordered=False, runner=runner)
+    for status in statuses:
+        if status.timed_out:
+            output.error(status.repo, 'TIMEOUT')
+            continue
 
-        report = parser.loads(cmd.stdout, repo_dir)
+        report = status.report
+        if report is None and status.stdout is not None:
+            report = parser.loads(status.stdout, status.repo)
+            if report is not None and cache is not None:
+                cache.store(status.repo, status.cache_key, report)
         if report is None:
-            print('UNKNOWN', repo_dir, repr(cmd.stdout))
+            output.error(status.repo, 'UNKNOWN', repr(status.stdout))
             continue
 
-        score = 100 * (report.ahead + report.behind) + (1 if report.uncommitted_changes else 0)
+        if args.include_unchanged or report.is_changed():
+            output.add(report)
 
-        include_result = args.include_unchanged or report.is_changed()
-
-        if include_result:
-            results.append((score, report))
-
-    results.sort(reverse=True)
-    def as_table(results: Iterable[BranchReport]):
-        yield "NAME", "BRANCH", "STATUS"
-
-        for _, r in results:
-            branch_msg = r.branch
-            if r.upstream:
-                upstream = r.upstream
-                if upstream.endswith('/' + r.branch):
-                    remote_name = r.upstream[:-len(r.branch)-1]
-                    upstream = f' ↙{remote_name}'
-                else:
-                    upstream = '...' + r.upstream
-
-                branch_msg += upstream
-
-            indicators = []
-            if r.ahead > 0:
-                indicators.append(format_indicator(f'↑{r.ahead}', 'ahead'))
-            if r.behind > 0:
-                indicators.append(format_indicator(f'↓{r.behind}', 'behind'))
-            if r.gone:
-                indicators.append(format_indicator('gone', 'gone'))
-            if r.uncommitted_changes:
-                indicators.append(format_indicator('*', 'uncommitted'))
-
-            yield r.repo.name, branch_msg, ' '.join(indicators)
-
-    print(tabulate(
-        list(as_table(results)),
-        headers="firstrow",
-        tablefmt="plain",
-    ))
+    if cache is not None:
+        cache.save()
+    output.close()
 
 if __name__ == "__main__":
     main()
@@ -1,25 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
-import configparser
+import importlib
+import os
 import sys
 import subprocess
-import re
-from typing import Optional
 import urllib.parse
 from dotfiles.git.url import parse_git_url
 from dotfiles.utils.inject import injector
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
-from functools import cached_property, wraps
-from pathlib import Path
+from functools import cache, cached_property, wraps
 
-config = configparser.ConfigParser()
+CONFIG_PATH = '~/.config/repoweb.ini'
 
 
-def git(args):
+@cache
+def read_config():
+    """The user configuration, only read (and configparser only imported) when needed."""
+    import configparser
+
+    config = configparser.ConfigParser()
+    config.read([os.path.expanduser(CONFIG_PATH)])
+    return config
+
+
+def git(args, cwd=None):
     proc = subprocess.run(
         ['git'] + args,
+        cwd=cwd,
         check=True,
         capture_output=True,
         encoding=sys.getdefaultencoding(),
@@ -50,6 +59,12 @@ class Platform(Enum):
 class PlatformRegistry:
     command_handlers = {}
     handler_factories = {}
+    # Built-in handlers, imported on first use as 'module:attribute'
+    handler_paths = {
+        Platform.GitLab: 'dotfiles.scripts.repoweb_platforms.gitlab:GitLabCommands',
+        Platform.GitHub: 'dotfiles.scripts.repoweb_platforms.github:GitHubCommands',
+        Platform.Bitbucket: 'dotfiles.scripts.repoweb_platforms.bitbucket:BitbucketCommands',
+    }
 
     @classmethod
     def register(cls, platform: Platform):
@@ -64,6 +79,11 @@ class PlatformRegistry:
         if platform in cls.command_handlers:
             return cls.command_handlers[platform]
 
+        if platform not in cls.handler_factories and platform in cls.handler_paths:
+            module_name, _, attribute = cls.handler_paths[platform].partition(':')
+            module = importlib.import_module(module_name)
+            cls.handler_factories[platform] = getattr(module, attribute)
+
         if not platform in cls.handler_factories:
             raise KeyError(f"Platform not mapped: {platform}")
 
@@ -71,6 +91,69 @@ class PlatformRegistry:
         return cls.command_handlers[platform]
 
 
+class GitQueries:
+    """
+    Git lookups for a single repository, run at most once per process.
+
+    Config is read with one `git config --get-regexp` call and refs are
+    resolved together with one `git rev-parse` call; commands get an instance
+    injected as `queries`.
+    """
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        self._commits = {}
+
+    def run(self, args) -> str:
+        return git(args, cwd=self.cwd)
+
+    @cached_property
+    def config(self) -> dict:
+        """The remote.* and url.* settings of the repository, as lists of values (keys as printed by git)."""
+        try:
+            stdout = self.run(['config', '-z', '--get-regexp', r'^(remote|url)\.'])
+        except subprocess.CalledProcessError as e:
+            # Exit status 1: no matching keys
+            if e.returncode == 1:
+                return {}
+            raise
+
+        values = {}
+        for entry in stdout.split('\0'):
+            if entry:
+                key, _, value = entry.partition('\n')
+                values.setdefault(key, []).append(value)
+        return values
+
+    @cached_property
+    def current_branch(self) -> str:
+        """The checked out branch, or HEAD if detached."""
+        # The commit of HEAD comes along for free; `commit` often asks for it next
+        commit, branch = self.run(['rev-parse', 'HEAD', '--abbrev-ref', 'HEAD']).split()
+        self._commits['HEAD'] = commit
+        return branch
+
+    def remote_url(self, remote_name: str) -> str:
+        # Like `git remote get-url`, the first of several URLs
+        url = self.config.get(f'remote.{remote_name}.url', [None])[0]
+        # insteadOf rewrites are applied by git itself
+        rewrites = any(key.startswith('url.') and key.endswith('.insteadof') for key in self.config)
+        if url is None or rewrites:
+            url = self.run(['remote', 'get-url', remote_name]).strip()
+        return url
+
+    def resolve(self, *refs) -> list:
+        """Resolve `refs` to commit ids, in one rev-parse call for those not seen before."""
+        missing = list(dict.fromkeys(ref for ref in refs if ref not in self._commits))
+        if missing:
+            commits = self.run(['rev-parse', *missing]).split()
+            self._commits.update(zip(missing, commits))
+        return [self._commits[ref] for ref in refs]
+
+    def commit(self, ref) -> str:
+        return self.resolve(ref)[0]
+
+
 @dataclass
 class RemoteRepository:
     fetch_url: str
@@ -82,13 +165,16 @@ class RemoteRepository:
 class Context:
     args: argparse.Namespace
     remote: RemoteRepository
+    queries: GitQueries = field(default_factory=GitQueries)
 
     @classmethod
-    def from_args(cls, args):
-        remote_url = get_remote_url(args.remote)
+    def from_args(cls, args, queries=None):
+        if queries is None:
+            queries = GitQueries()
+        remote_url = queries.remote_url(args.remote)
         remote = resolve_remote_repository(remote_url)
 
-        return cls(args=args, remote=remote)
+        return cls(args=args, remote=remote, queries=queries)
 
     @cached_property
     def injector(self):
@@ -96,6 +182,7 @@ class Context:
             context=self,
             args=self.args,
             remote=self.remote,
+            queries=self.queries,
         ))
 
     @property
@@ -120,11 +207,6 @@ class Context:
 
 
 
-def get_remote_url(remote_name):
-    stdout = git(['remote', 'get-url', remote_name])
-    return stdout.strip()
-
-
 def get_repository_platform(url: urllib.parse.SplitResult) -> Platform:
     """
     Platform for custom domains can be configured in the 'repoweb.ini' file
@@ -139,7 +221,7 @@ def get_repository_platform(url: urllib.parse.SplitResult) -> Platform:
     if hostname is None:
         raise ValueError('hostname is None', url)
 
-    platform_name = config.get('CustomDomains', hostname, fallback=None)
+    platform_name = read_config().get('CustomDomains', hostname, fallback=None)
     if platform_name is None:
         raise ValueError(f"Host currently not supported: {url.hostname}")
 
@@ -184,23 +266,13 @@ def resolve_remote_repository(remote_url: str) -> RemoteRepository:
     )
 
 
-def get_current_branch():
-    stdout = git(['rev-parse', '--abbrev-ref', 'HEAD'])
-    branch_name = stdout.strip()
-    return branch_name
-
-
-def resolve_ref(ref):
+def resolve_ref(ref, queries: GitQueries):
     if ref is None or not ref:
-        return get_current_branch()
+        return queries.current_branch
     else:
         return ref
 
 
-def resolve_ref_as_commit(ref) -> str:
-    return git(['rev-parse', ref]).strip()
-
-
 class open_url_command:
     def __init__(self, path=None, *, url=None):
         def default_url_factory(remote: RemoteRepository, context: Context) -> str:
@@ -266,152 +338,6 @@ class PlatformCommands:
         return getattr(self, command.name)
 
 
-@PlatformRegistry.register(Platform.Bitbucket)
-class BitbucketCommands(PlatformCommands):
-    @classmethod
-    def pull_request_state(cls, state: Optional[str]) -> Optional[str]:
-        return {
-            'opened': 'OPEN',
-            'closed': 'DECLINED',
-            'merged': 'MERGED',
-            'all': 'ALL',
-        }.get(state)
-
-    view_any = open_url_command(lambda args: args.page.lstrip('/'))
-
-    view_commit = open_url_command(
-        lambda args: 'commits/' + resolve_ref_as_commit(resolve_ref(args.ref))
-    )
-
-    view_merge_requests = open_url_command(lambda args: 'pull-requests/' + query_string({
-        'state': BitbucketCommands.pull_request_state(args.state),
-    }))
-
-    create_merge_request = open_url_command(lambda args: 'pull-requests/new' + query_string({
-        'source': args.source_branch or get_current_branch(),
-        'dest': args.target_branch,
-    }))
-
-
-@PlatformRegistry.register(Platform.GitLab)
-class GitLabCommands(PlatformCommands):
-    @staticmethod
-    def _merge_request_state(state: Optional[MergeRequestState]) -> Optional[str]:
-        return {
-            MergeRequestState.Open: 'opened',
-            MergeRequestState.Closed: 'closed',
-            MergeRequestState.Merged: 'merged',
-            MergeRequestState.All: 'all',
-        }.get(state)
-
-    create_new_repo = open_url_command(url='https://gitlab.com/projects/new')
-    view_issues = open_url_command('-/issues')
-    new_issue = open_url_command('-/issues/new')
-    view_merge_requests = open_url_command(lambda args: '-/merge_requests' + query_string({
-        'state': GitLabCommands._merge_request_state(args.state),
-    }))
-    view_pipelines = open_url_command('-/pipelines')
-    view_any = open_url_command(lambda args: args.page.lstrip('/'))
-    view_tree = open_url_command(lambda args: '-/tree/' + resolve_ref(args.ref))
-    view_commit = open_url_command(
-        lambda args: '-/commit/' + resolve_ref_as_commit(resolve_ref(args.ref))
-    )
-    view_branches = open_url_command('-/branches')
-
-    view_packages = open_url_command('-/packages')
-    view_container_registry = open_url_command('container_registry')
-
-    def _create_settings_path(args):
-        page = re.sub(r'[ -_/]+', '_', args.page.lower())
-
-        pages = {
-            'general': 'edit',
-            'integrations': '-/settings/integrations',
-            'webhooks': '-/hooks',
-            'access_tokens': '-/settings/access_tokens',
-            'repository': '-/settings/repository',
-            'ci_cd': '-/settings/ci_cd',
-            'monitor': '-/settings/operations',
-            'operations': '-/settings/operations',
-            'pages': 'pages',
-            'packages': '-/settings/packages_and_registries',
-            'registries': '-/settings/packages_and_registries',
-            'packages_and_registries': '-/settings/packages_and_registries',
-        }
-
-        return pages[page]
-
-    view_settings = open_url_command(_create_settings_path)
-
-    def _create_merge_request_path(args):
-        params = {
-            'merge_request[source_branch]': args.source_branch or get_current_branch(),
-            'merge_request[target_branch]': args.target_branch,
-        }
-
-        return '-/merge_requests/new' + query_string(params)
-
-    create_merge_request = open_url_command(_create_merge_request_path)
-
-
-@PlatformRegistry.register(Platform.GitHub)
-class GitHubCommands(PlatformCommands):
-    @staticmethod
-    def _issue_state_query(state: MergeRequestState) -> str:
-        return {
-            MergeRequestState.Closed: 'is:closed',
-            MergeRequestState.Merged: 'is:merged',
-            MergeRequestState.Open: 'is:open',
-        }[state]
-
-    def _create_settings_path(args):
-        page = re.sub(r'[ -_/]+', '_', args.page.lower())
-
-        pages = {
-            'main': 'settings',
-            'general': 'settings',
-            'options': 'settings',
-            'access': 'settings/access',
-            'security': 'settings/security_analysis',
-            'security_analysis': 'settings/security_analysis',
-            'branches': 'settings/branches',
-            'webhooks': 'settings/hooks',
-            'hooks': 'settings/hooks',
-            'notifications': 'settings/notifications',
-            'integrations': 'settings/installations',
-            'deploy_keys': 'settings/keys',
-            'keys': 'settings/keys',
-            'actions': 'settings/actions',
-            'environments': 'settings/environments',
-            'secrets': 'settings/secrets/actions',
-            'pages': 'settings/pages',
-            'moderation': 'settings/interaction_limits',
-        }
-
-        return pages[page]
-
-    def _create_merge_request_path(args):
-        source_branch = args.source_branch or get_current_branch()
-        target_branch = args.target_branch
-
-        return f'compare/{target_branch}...{source_branch}'
-
-    create_new_repo = open_url_command('/new')
-    view_issues = open_url_command('issues')
-    new_issue = open_url_command('issues/new')
-    view_merge_requests = open_url_command(
-        lambda args: 'pulls' + query_string({'q': GitHubCommands._issue_state_query(args.state)}))
-    view_pipelines = open_url_command('actions')
-    view_any = open_url_command(lambda args: args.page.lstrip('/'))
-    view_tree = open_url_command(lambda args: 'tree/' + resolve_ref(args.ref))
-    view_commit = open_url_command(
-        lambda args: 'commit/' + resolve_ref_as_commit(resolve_ref(args.ref))
-    )
-    view_branches = open_url_command('branches')
-    view_settings = open_url_command(_create_settings_path)
-    create_merge_request = open_url_command(_create_merge_request_path)
-
-
 def main_handler(args):
     context = Context.from_args(args)
 
@@ -423,6 +349,68 @@ def main_handler(args):
         handler.visit_url(context)
 
 
+@dataclass
+class BatchEntry:
+    path: str
+    ref: str | None = None
+
+
+def read_batch(stream, separator='\n') -> list:
+    """Read `path` or `path<TAB>ref` entries, as printed by git-allrepos."""
+    entries = []
+    for line in stream.read().split(separator):
+        line = line.rstrip('\r') if separator == '\n' else line
+        if not line:
+            continue
+        path, _, ref = line.partition('\t')
+        entries.append(BatchEntry(path, ref or None))
+    return entries
+
+
+def batch_url(args, entry: BatchEntry) -> str:
+    if entry.ref is not None:
+        # The ref stands for the `ref` argument, or the source branch of a merge request
+        key = 'source_branch' if 'source_branch' in args else 'ref'
+        args = argparse.Namespace(**{**vars(args), key: entry.ref})
+
+    context = Context.from_args(args, GitQueries(cwd=entry.path))
+    return context.resolve_command_handler().get_url(context)
+
+
+def describe_error(error: Exception) -> str:
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+        return error.stderr.strip().splitlines()[-1]
+    return str(error) or type(error).__name__
+
+
+def batch_handler(args, stream=None) -> int:
+    """
+    Resolve the URL of each entry read from `stream` (stdin by default)
+    concurrently, and print them in the input order. Entries that fail are
+    reported on stderr and leave an empty line, so output lines still match
+    input lines. Return the exit status.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = read_batch(stream or sys.stdin, '\0' if args.null_separator else '\n')
+    status = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(batch_url, args, entry) for entry in entries]
+        for entry, future in zip(entries, futures):
+            try:
+                url = future.result()
+            except Exception as e:
+                print(f'repoweb: {entry.path}: {describe_error(e)}', file=sys.stderr)
+                print()
+                status = 1
+                continue
+
+            print(url, flush=True)
+            if not args.print_only:
+                browse(url)
+    return status
+
+
 def make_subparser(command_handler, *aliases, help, extra_defaults=None):
     main_name, *aliases = aliases
 
@@ -440,15 +428,20 @@ def make_subparser(command_handler, *aliases, help, extra_defaults=None):
 
         return parser
 
+    _subparser_factory.names = (main_name, *aliases)
     return _subparser_factory
 
 
 def subparser_builder(*args, **kwargs):
     def inner(subparser_configurator):
+        factory = make_subparser(*args, **kwargs)
+
         @wraps(subparser_configurator)
         def configure_subparser(self, subparsers):
-            parser = make_subparser(*args, **kwargs)(self, subparsers)
+            parser = factory(self, subparsers)
             subparser_configurator(self, parser)
+
+        configure_subparser.names = factory.names
         return configure_subparser
     return inner
 
@@ -555,18 +548,14 @@ class CliParserBuilder:
             help='set the source branch (defaults to currently checked out branch)',
         )
 
-    def add_subparsers(self, parser):
+    def add_subparsers(self, parser, factories):
         subparsers = parser.add_subparsers(
             help='sub-command help',
         )
-        for factory in self._get_subparser_factories():
-            factory(subparsers)
-
-    def build(self):
-        parser = argparse.ArgumentParser(
-            description='Open GitLab pages on your web browser'
-        )
+        for factory in factories:
+            factory(self, subparsers)
 
+    def add_options(self, parser):
         parser.add_argument(
             '-p',
             '--print-only',
@@ -580,34 +569,99 @@ class CliParserBuilder:
             default='origin',
             help='set the remote that should be used (defaults to origin)',
         )
+
+        parser.add_argument(
+            '--batch',
+            action='store_true',
+            help='read repository paths from standard input, one per line, each optionally '
+                 'followed by a tab and a ref, and print one URL per line in the same order',
+        )
+
+        parser.add_argument(
+            '-0',
+            '--null',
+            action='store_true',
+            dest='null_separator',
+            help='with --batch, read entries separated by NUL (\\0) instead of newline',
+        )
+
+        parser.add_argument(
+            '-j',
+            '--jobs',
+            type=int,
+            default=8,
+            metavar='N',
+            help='with --batch, look up N repositories at once (defaults to 8)',
+        )
         # TODO: default to first remote (as returned by `git remote`) if `origin`
         # does not exist or is not a GitLab repo
 
-        self.add_subparsers(parser)
+    def build(self, argv=None):
+        """
+        Build the parser. Given the command line `argv`, only the sub-command
+        it names is set up; help and usage errors still get all of them.
+        """
+        parser = argparse.ArgumentParser(
+            description='Open GitLab pages on your web browser'
+        )
+        self.add_options(parser)
+
+        factories = self._get_subparser_factories()
+        if argv is not None:
+            command = self._find_command(argv)
+            # An unknown or missing command matches no factory: set up all of
+            # them, so that argparse reports it with the full list of choices
+            factories = [factory for factory in factories if command in factory.names] or factories
+
+        self.add_subparsers(parser, factories)
 
         return parser
 
-    def _get_subparser_factories(self):
+    def _find_command(self, argv) -> str | None:
+        """
+        The sub-command named in `argv`, found by parsing the top-level options
+        alone. None if help is requested before it, or if those options are invalid.
+        """
+        parser = argparse.ArgumentParser(add_help=False, exit_on_error=False)
+        self.add_options(parser)
+        try:
+            _, rest = parser.parse_known_args(argv)
+        except argparse.ArgumentError:
+            return None
+
+        for arg in rest:
+            if arg in ('-h', '--help'):
+                return None
+            if not arg.startswith('-'):
+                return arg
+        return None
+
+    @classmethod
+    def _get_subparser_factories(cls):
+        # In definition order, which is also the order shown in the help
         return [
-            getattr(self, method_name)
-            for method_name in dir(self)
-            if method_name.startswith('subparser_')
+            factory
+            for name, factory in vars(cls).items()
+            if name.startswith('subparser_')
         ]
 
 def main():
-    config.read([
-        Path('~/.config/repoweb.ini').expanduser(),
-    ])
-
-    parser = CliParserBuilder().build()
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    parser = CliParserBuilder().build(argv)
+    args = parser.parse_args(argv)
 
     if not 'command' in args:
         parser.print_usage()
         sys.exit(1)
 
+    if args.batch:
+        sys.exit(batch_handler(args))
+
     main_handler(args)
 
 
 if __name__ == '__main__':
+    # Platform handlers import dotfiles.scripts.repoweb, which is not this
+    # copy of the module: run that one's main so both share the same classes
+    from dotfiles.scripts.repoweb import main
     main()
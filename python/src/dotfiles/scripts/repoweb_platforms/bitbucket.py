@@ -0,0 +1,29 @@
+from typing import Optional
+
+from dotfiles.scripts.repoweb import PlatformCommands, open_url_command, query_string, resolve_ref
+
+
+class BitbucketCommands(PlatformCommands):
+    @classmethod
+    def pull_request_state(cls, state: Optional[str]) -> Optional[str]:
+        return {
+            'opened': 'OPEN',
+            'closed': 'DECLINED',
+            'merged': 'MERGED',
+            'all': 'ALL',
+        }.get(state)
+
+    view_any = open_url_command(lambda args: args.page.lstrip('/'))
+
+    view_commit = open_url_command(
+        lambda args, queries: 'commits/' + queries.commit(resolve_ref(args.ref, queries))
+    )
+
+    view_merge_requests = open_url_command(lambda args: 'pull-requests/' + query_string({
+        'state': BitbucketCommands.pull_request_state(args.state),
+    }))
+
+    create_merge_request = open_url_command(lambda args, queries: 'pull-requests/new' + query_string({
+        'source': args.source_branch or queries.current_branch,
+        'dest': args.target_branch,
+    }))
@@ -0,0 +1,62 @@
+import re
+
+from dotfiles.scripts.repoweb import (
+    MergeRequestState, PlatformCommands, open_url_command, query_string, resolve_ref,
+)
+
+
+class GitHubCommands(PlatformCommands):
+    @staticmethod
+    def _issue_state_query(state: MergeRequestState) -> str:
+        return {
+            MergeRequestState.Closed: 'is:closed',
+            MergeRequestState.Merged: 'is:merged',
+            MergeRequestState.Open: 'is:open',
+        }[state]
+
+    def _create_settings_path(args):
+        page = re.sub(r'[ -_/]+', '_', args.page.lower())
+
+        pages = {
+            'main': 'settings',
+            'general': 'settings',
+            'options': 'settings',
+            'access': 'settings/access',
+            'security': 'settings/security_analysis',
+            'security_analysis': 'settings/security_analysis',
+            'branches': 'settings/branches',
+            'webhooks': 'settings/hooks',
+            'hooks': 'settings/hooks',
+            'notifications': 'settings/notifications',
+            'integrations': 'settings/installations',
+            'deploy_keys': 'settings/keys',
+            'keys': 'settings/keys',
+            'actions': 'settings/actions',
+            'environments': 'settings/environments',
+            'secrets': 'settings/secrets/actions',
+            'pages': 'settings/pages',
+            'moderation': 'settings/interaction_limits',
+        }
+
+        return pages[page]
+
+    def _create_merge_request_path(args, queries):
+        source_branch = args.source_branch or queries.current_branch
+        target_branch = args.target_branch
+
+        return f'compare/{target_branch}...{source_branch}'
+
+    create_new_repo = open_url_command('/new')
+    view_issues = open_url_command('issues')
+    new_issue = open_url_command('issues/new')
+    view_merge_requests = open_url_command(
+        lambda args: 'pulls' + query_string({'q': GitHubCommands._issue_state_query(args.state)}))
+    view_pipelines = open_url_command('actions')
+    view_any = open_url_command(lambda args: args.page.lstrip('/'))
+    view_tree = open_url_command(lambda args, queries: 'tree/' + resolve_ref(args.ref, queries))
+    view_commit = open_url_command(
+        lambda args, queries: 'commit/' + queries.commit(resolve_ref(args.ref, queries))
+    )
+    view_branches = open_url_command('branches')
+    view_settings = open_url_command(_create_settings_path)
+    create_merge_request = open_url_command(_create_merge_request_path)
@@ -0,0 +1,66 @@
+import re
+from typing import Optional
+
+from dotfiles.scripts.repoweb import (
+    MergeRequestState, PlatformCommands, open_url_command, query_string, resolve_ref,
+)
+
+
+class GitLabCommands(PlatformCommands):
+    @staticmethod
+    def _merge_request_state(state: Optional[MergeRequestState]) -> Optional[str]:
+        return {
+            MergeRequestState.Open: 'opened',
+            MergeRequestState.Closed: 'closed',
+            MergeRequestState.Merged: 'merged',
+            MergeRequestState.All: 'all',
+        }.get(state)
+
+    create_new_repo = open_url_command(url='https://gitlab.com/projects/new')
+    view_issues = open_url_command('-/issues')
+    new_issue = open_url_command('-/issues/new')
+    view_merge_requests = open_url_command(lambda args: '-/merge_requests' + query_string({
+        'state': GitLabCommands._merge_request_state(args.state),
+    }))
+    view_pipelines = open_url_command('-/pipelines')
+    view_any = open_url_command(lambda args: args.page.lstrip('/'))
+    view_tree = open_url_command(lambda args, queries: '-/tree/' + resolve_ref(args.ref, queries))
+    view_commit = open_url_command(
+        lambda args, queries: '-/commit/' + queries.commit(resolve_ref(args.ref, queries))
+    )
+    view_branches = open_url_command('-/branches')
+
+    view_packages = open_url_command('-/packages')
+    view_container_registry = open_url_command('container_registry')
+
+    def _create_settings_path(args):
+        page = re.sub(r'[ -_/]+', '_', args.page.lower())
+
+        pages = {
+            'general': 'edit',
+            'integrations': '-/settings/integrations',
+            'webhooks': '-/hooks',
+            'access_tokens': '-/settings/access_tokens',
+            'repository': '-/settings/repository',
+            'ci_cd': '-/settings/ci_cd',
+            'monitor': '-/settings/operations',
+            'operations': '-/settings/operations',
+            'pages': 'pages',
+            'packages': '-/settings/packages_and_registries',
+            'registries': '-/settings/packages_and_registries',
+            'packages_and_registries': '-/settings/packages_and_registries',
+        }
+
+        return pages[page]
+
+    view_settings = open_url_command(_create_settings_path)
+
+    def _create_merge_request_path(args, queries):
+        params = {
+            'merge_request[source_branch]': args.source_branch or queries.current_branch,
+            'merge_request[target_branch]': args.target_branch,
+        }
+
+        return '-/merge_requests/new' + query_string(params)
+
+    create_merge_request = open_url_command(_create_merge_request_path)
@@ -0,0 +1,414 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+import pytest
+
+from dotfiles.scripts import fsindex
+
+
+@pytest.fixture
+def con(tmp_path):
+    con = fsindex.connect(tmp_path / 'fsindex.db')
+    yield con
+    con.close()
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'library'
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'top.txt').write_text('top')
+    (root / 'a' / 'one.txt').write_text('one')
+    (root / 'a' / 'b' / 'two.txt').write_text('two')
+    return root
+
+
+@pytest.fixture
+def lib(con, tree):
+    with con:
+        return fsindex.add_library(con.cursor(), 'test', str(tree))
+
+
+def backdate(path, seconds=60):
+    st = path.stat()
+    os.utime(path, (st.st_atime - seconds, st.st_mtime - seconds))
+
+
+def live_files(con, lib):
+    res = con.execute(
+        "select path, size from file_path where library_id = ? and deleted_at is null",
+        (lib.id,),
+    )
+    return {row['path']: row['size'] for row in res.fetchall()}
+
+
+def test_rescan_does_not_duplicate(con, tree, lib):
+    fsindex.scan_library(con, lib, tree)
+    stats = fsindex.scan_library(con, lib, tree, full=True)
+
+    assert stats.files_added == 0
+    assert stats.files_unchanged == 3
+    assert con.execute("select count(*) as n from file").fetchone()['n'] == 3
+
+
+def test_scan_command(tmp_path, tree, capsys):
+    db = tmp_path / 'cli.db'
+    for _ in range(2):
+        fsindex.main(['--db', str(db), 'scan', 'cli', str(tree)])
+
+    out = capsys.readouterr().out
+    assert 'files_added=3' in out
+
+    con = fsindex.connect(db)
+    fsindex.tune_for_ingest(con)
+    assert con.execute("pragma synchronous").fetchone()['synchronous'] == 1
+    con.close()
+
+
+def test_rescan_skips_unchanged_directories(con, tree, lib):
+    for d in (tree, tree / 'a', tree / 'a' / 'b'):
+        backdate(d)
+    fsindex.scan_library(con, lib, tree)
+
+    (tree / 'a' / 'b' / 'three.txt').write_text('three')
+    stats = fsindex.scan_library(con, lib, tree)
+
+    assert stats.dirs_skipped == 2
+    assert stats.dirs_listed == 1
+    assert stats.files_added == 1
+    assert 'a/b/three.txt' in live_files(con, lib)
+
+
+def test_rescan_updates_and_deletes(con, tree, lib):
+    fsindex.scan_library(con, lib, tree)
+
+    (tree / 'a' / 'one.txt').write_text('changed')
+    (tree / 'top.txt').unlink()
+    (tree / 'a' / 'b' / 'two.txt').unlink()
+    (tree / 'a' / 'b').rmdir()
+    stats = fsindex.scan_library(con, lib, tree, full=True)
+
+    assert stats.files_updated == 1
+    assert stats.files_deleted == 2
+    assert stats.dirs_deleted == 1
+    assert live_files(con, lib) == {'a/one.txt': len('changed')}
+
+
+def test_scan_refuses_emptied_root(con, tree, lib):
+    fsindex.scan_library(con, lib, tree)
+    for entry in list(tree.iterdir()):
+        shutil.rmtree(entry) if entry.is_dir() else entry.unlink()
+
+    for full in (False, True):
+        with pytest.raises(fsindex.LibraryRootChanged, match='was it unmounted'):
+            fsindex.scan_library(con, lib, tree, full=full)
+    assert len(live_files(con, lib)) == 3
+
+    stats = fsindex.scan_library(con, lib, tree, allow_empty=True)
+    assert stats.files_deleted == 3
+    assert live_files(con, lib) == {}
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_scan_with_jobs(con, tree, lib, jobs):
+    for i in range(20):
+        d = tree / f'dir{i}'
+        d.mkdir()
+        (d / 'file.txt').write_text(str(i))
+
+    stats = fsindex.scan_library(con, lib, tree, jobs=jobs)
+
+    assert stats.dirs_listed == 23
+    assert len(live_files(con, lib)) == 23
+
+
+def query_plan(con, query):
+    sql, params = query.to_sql()
+    res = con.execute('explain query plan ' + sql, params)
+    return ' / '.join(row['detail'] for row in res.fetchall())
+
+
+@pytest.mark.parametrize('query,index', [
+    (fsindex.FileQuery(name='IMG_*'), 'file_live_name'),
+    (fsindex.FileQuery(library='photos', name='IMG_*'), 'file_live_name'),
+    (fsindex.FileQuery(largest=True, limit=10), 'file_live_size'),
+    (fsindex.FileQuery(since=datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC)), 'file_live_mtime'),
+    (fsindex.FileQuery(library='photos', path='2024/*'), 'directory_path'),
+])
+def test_queries_use_indexes(con, query, index):
+    plan = query_plan(con, query)
+
+    assert f'INDEX {index}' in plan
+    assert 'SCAN f' not in plan or f'SCAN f USING INDEX {index}' in plan
+
+
+def test_find_files(con, tree, lib):
+    (tree / 'top.txt').write_text('the largest file')
+    fsindex.scan_library(con, lib, tree)
+    (tree / 'a' / 'one.txt').unlink()
+    fsindex.scan_library(con, lib, tree, full=True)
+
+    largest = fsindex.find_files(con.cursor(), fsindex.FileQuery(largest=True, limit=1))
+    by_name = fsindex.find_files(con.cursor(), fsindex.FileQuery(name='*.txt'))
+
+    assert [row['path'] for row in largest] == ['top.txt']
+    assert [row['path'] for row in by_name] == ['a/b/two.txt', 'top.txt']
+
+
+def test_duplicates(con, tree, lib):
+    big = os.urandom(3 * fsindex.PARTIAL_HASH_SIZE)
+    middle = fsindex.PARTIAL_HASH_SIZE + 1
+    (tree / 'big1.bin').write_bytes(big)
+    (tree / 'a' / 'big2.bin').write_bytes(big)
+    # Same size and same ends: only a full hash tells it apart
+    (tree / 'a' / 'b' / 'big3.bin').write_bytes(big[:middle] + b'x' + big[middle + 1:])
+    (tree / 'a' / 'top-copy.txt').write_text('top')
+    fsindex.scan_library(con, lib, tree)
+
+    stats = fsindex.hash_candidates(con, jobs=2)
+    groups = fsindex.find_duplicates(con.cursor())
+
+    assert stats.partial_hashed == 7
+    assert stats.fully_hashed == 3
+    assert [[row['path'] for row in group] for group in groups] == [
+        ['a/big2.bin', 'big1.bin'],
+        ['a/top-copy.txt', 'top.txt'],
+    ]
+
+    (tree / 'a' / 'b' / 'two.txt').write_text('new')
+    fsindex.scan_library(con, lib, tree, full=True)
+    stats = fsindex.hash_candidates(con, jobs=2)
+
+    assert stats.cached == 6
+    assert stats.partial_hashed == 1
+    assert stats.fully_hashed == 0
+
+
+def test_hash_skips_unmounted_libraries(con, tree, lib):
+    fsindex.scan_library(con, lib, tree)
+    with con:
+        unmounted = fsindex.add_library(con.cursor(), 'unmounted')
+    fsindex.scan_library(con, unmounted, tree)
+
+    stats = fsindex.hash_candidates(con, jobs=1)
+
+    # The three files of the mounted library, all of the same size
+    assert stats.partial_hashed == 3
+    assert stats.unreadable == 0
+
+
+@pytest.mark.parametrize('text,expression', [
+    ('holi', '"holi"*'),
+    ('holiday beach', '"holiday"* "beach"*'),
+    ('"summer 2024" img', '"summer 2024" "img"*'),
+    ('say"hi', '"say""hi"*'),
+])
+def test_match_expression(text, expression):
+    assert fsindex.match_expression(text) == expression
+
+
+@pytest.mark.parametrize('text', ['', '  ', '""', '" "  ""'])
+def test_match_expression_rejects_empty_input(text):
+    with pytest.raises(ValueError, match='no search terms'):
+        fsindex.match_expression(text)
+
+
+def search(con, text, **kwargs):
+    rows = fsindex.search_files(con.cursor(), fsindex.match_expression(text), **kwargs)
+    return [row['path'] for row in rows]
+
+
+@pytest.mark.parametrize('argv', [['--raw', 'a AND'], ['""']])
+def test_search_command_reports_bad_input(tmp_path, capsys, argv):
+    with pytest.raises(SystemExit) as exit:
+        fsindex.main(['--db', str(tmp_path / 'cli.db'), 'search', *argv])
+
+    assert exit.value.code == 1
+    assert capsys.readouterr().err.startswith('error: ')
+
+
+def test_search_follows_file_changes(con, tree, lib):
+    (tree / 'a' / 'Holiday Photos.jpg').write_text('photo')
+    fsindex.scan_library(con, lib, tree)
+
+    assert search(con, 'holi') == ['a/Holiday Photos.jpg']
+    assert search(con, '"holiday photos"') == ['a/Holiday Photos.jpg']
+    assert search(con, '"photos holiday"') == []
+    assert search(con, 'a', names_only=True) == []
+
+    (tree / 'a' / 'Holiday Photos.jpg').rename(tree / 'a' / 'Beach.jpg')
+    fsindex.scan_library(con, lib, tree, full=True)
+
+    assert search(con, 'holi') == []
+    assert search(con, 'beach') == ['a/Beach.jpg']
+    con.execute("insert into file_fts (file_fts) values ('integrity-check')")
+
+
+def test_fts_migration_indexes_existing_files(tmp_path):
+    con = sqlite3.connect(tmp_path / 'fsindex.db')
+    con.row_factory = fsindex.dict_factory
+    for version in range(1, 5):
+        fsindex.db_schemas.get(version).execute(con.cursor())
+    with con:
+        con.execute("insert into library (name) values ('test')")
+        con.executemany(
+            """
+            insert into file (library_id, path, name, size, mtime, deleted_at)
+            values (1, ?, ?, 1, '2024-01-01', ?)
+            """,
+            [('a/live.txt', 'live.txt', None), ('a/gone.txt', 'gone.txt', '2024-01-02')],
+        )
+    con.close()
+
+    con = fsindex.connect(tmp_path / 'fsindex.db')
+
+    assert search(con, 'live') == ['a/live.txt']
+    assert search(con, 'gone') == []
+    con.execute("insert into file_fts (file_fts) values ('integrity-check')")
+    con.close()
+
+
+def export_import(source_con, lib, target_con, target, tmp_path):
+    snapshot = str(tmp_path / 'snapshot.ndjson.gz')
+    with fsindex.open_snapshot(snapshot, 'w') as out:
+        fsindex.export_library(source_con.cursor(), lib, out)
+
+    with fsindex.open_snapshot(snapshot, 'r') as lines:
+        header, directories = fsindex.read_snapshot(lines)
+        assert header['library']['name'] == lib.name
+        return fsindex.merge_snapshot(target_con, target, directories)
+
+
+def test_snapshot_merge(con, tree, lib, tmp_path):
+    other = fsindex.connect(tmp_path / 'other.db')
+    fsindex.scan_library(con, lib, tree)
+    (tree / 'a' / 'one-copy.txt').write_text('one')
+    fsindex.hash_candidates(con, jobs=1)
+
+    with other:
+        target = fsindex.add_library(other.cursor(), 'test')
+    stats = export_import(con, lib, other, target, tmp_path)
+
+    assert stats.files_added == 3
+    assert live_files(other, target) == live_files(con, lib)
+    assert search(other, 'two') == ['a/b/two.txt']
+
+    (tree / 'top.txt').unlink()
+    (tree / 'a' / 'b' / 'two.txt').write_text('changed')
+    fsindex.scan_library(con, lib, tree, full=True)
+
+    stats = export_import(con, lib, other, target, tmp_path)
+
+    assert stats.files_updated == 1
+    assert stats.files_deleted == 1
+    assert stats.files_unchanged == 1
+    assert live_files(other, target) == live_files(con, lib)
+    other.close()
+
+
+# Changes must show up in the index within this many seconds
+WATCH_LATENCY = 5.0
+
+
+@pytest.fixture
+def watcher(tmp_path, tree, lib):
+    stop = threading.Event()
+    ready = threading.Event()
+
+    def run():
+        con = fsindex.connect(tmp_path / 'fsindex.db')
+        watcher = fsindex.LibraryWatcher(
+            con, lib, tree, settle=0.05, max_delay=0.5, poll_interval=0.1,
+        )
+        try:
+            watcher.run(stop, on_change=lambda stats: ready.set())
+        finally:
+            watcher.close()
+            con.close()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert ready.wait(WATCH_LATENCY)
+    yield
+    stop.set()
+    thread.join()
+
+
+def converges(con, lib, expected):
+    deadline = time.monotonic() + WATCH_LATENCY
+    while time.monotonic() < deadline:
+        # End the implicit read transaction, whose snapshot would hide the watcher's commits
+        con.rollback()
+        if set(live_files(con, lib)) == expected:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='inotify is Linux only')
+def test_watch_converges(con, tree, lib, watcher):
+    assert converges(con, lib, {'top.txt', 'a/one.txt', 'a/b/two.txt'})
+
+    (tree / 'new.txt').write_text('new')
+    (tree / 'c' / 'd').mkdir(parents=True)
+    (tree / 'c' / 'd' / 'deep.txt').write_text('deep')
+    (tree / 'a' / 'one.txt').unlink()
+    assert converges(con, lib, {'top.txt', 'a/b/two.txt', 'new.txt', 'c/d/deep.txt'})
+
+    (tree / 'c').rename(tree / 'a' / 'c')
+    shutil.rmtree(tree / 'a' / 'b')
+    assert converges(con, lib, {'top.txt', 'new.txt', 'a/c/d/deep.txt'})
+
+    (tree / 'a' / 'c' / 'd' / 'moved-in.txt').write_text('still watched')
+    assert converges(con, lib, {'top.txt', 'new.txt', 'a/c/d/deep.txt', 'a/c/d/moved-in.txt'})
+
+
+class InterruptingProgress(fsindex.Progress):
+    def __init__(self, after: int):
+        super().__init__()
+        self.after = after
+
+    def update(self, stats, force=False):
+        if stats.dirs_listed >= self.after:
+            raise KeyboardInterrupt
+
+    def close(self, stats):
+        pass
+
+
+def test_interrupted_scan_resumes(con, tree, lib):
+    with pytest.raises(KeyboardInterrupt):
+        fsindex.scan_library(
+            con, lib, tree, full=True, jobs=1, batch_size=1, commit_size=1,
+            progress=InterruptingProgress(after=1),
+        )
+
+    [run] = fsindex.list_scan_runs(con.cursor())
+    assert run['status'] == 'interrupted'
+    assert run['dirs_listed'] == 1
+
+    stats = fsindex.scan_library(con, lib, tree, full=True, jobs=1)
+
+    assert stats.dirs_skipped == 1
+    assert stats.dirs_listed == 3
+    assert set(live_files(con, lib)) == {'top.txt', 'a/one.txt', 'a/b/two.txt'}
+
+    [run] = fsindex.list_scan_runs(con.cursor())
+    assert run['status'] == 'finished'
+    assert run['files_added'] == 3
+    assert run['files_per_second'] > 0
+
+
+def test_new_kind_of_scan_abandons_unfinished_run(con, tree, lib):
+    with pytest.raises(KeyboardInterrupt):
+        fsindex.scan_library(con, lib, tree, jobs=1, progress=InterruptingProgress(after=1))
+
+    fsindex.scan_library(con, lib, tree, full=True)
+
+    runs = fsindex.list_scan_runs(con.cursor())
+    assert [run['status'] for run in runs] == ['finished', 'abandoned']
@@ -0,0 +1,124 @@
+import subprocess
+
+import pytest
+
+from dotfiles.scripts import git_allrepos
+
+
+def make_repo(path):
+    (path / '.git').mkdir(parents=True)
+    return str(path)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'src'
+    repos = [
+        make_repo(root / 'a'),
+        make_repo(root / 'group' / 'b'),
+        make_repo(root / 'group' / 'deeper' / 'c'),
+    ]
+    # Never reported: nested in a repo, or under a pruned directory
+    make_repo(root / 'a' / 'nested')
+    make_repo(root / 'group' / 'node_modules' / 'dep')
+    (root / 'empty').mkdir()
+    (root / 'file').write_text('')
+    return root, repos
+
+
+def test_discover_depths(tree):
+    root, (a, b, c) = tree
+
+    assert git_allrepos.find_child_repos(root, 0) == [a]
+    assert git_allrepos.find_child_repos(root, 1) == [a, b]
+    assert git_allrepos.find_child_repos(root, 5, jobs=4) == [a, b, c]
+
+
+def test_discover_follows_symlinks(tree, tmp_path):
+    root, (a, b, c) = tree
+    (tmp_path / 'links').mkdir()
+    (tmp_path / 'links' / 'b').symlink_to(b)
+
+    assert git_allrepos.find_child_repos(tmp_path / 'links', 0) == [b]
+
+
+def test_discovery_cache(tree, tmp_path, monkeypatch):
+    root, (a, b, c) = tree
+    cache_path = tmp_path / 'cache.json'
+    listed = []
+    list_directory = git_allrepos.list_directory
+    monkeypatch.setattr(git_allrepos, 'list_directory',
+                        lambda path, prune: listed.append(path) or list_directory(path, prune))
+
+    def discover():
+        cache = git_allrepos.DiscoveryCache(cache_path).load()
+        repos = git_allrepos.find_child_repos(root, 2, cache=cache)
+        cache.save()
+        return repos
+
+    assert discover() == [a, b, c]
+    assert len(listed) == 4
+
+    listed.clear()
+    assert discover() == [a, b, c]
+    assert listed == []
+
+    d = make_repo(root / 'group' / 'deeper' / 'd')
+    (root / 'a' / '.git').rmdir()
+
+    listed.clear()
+    assert discover() == [str(root / 'a' / 'nested'), b, c, d]
+    # Listings of changed directories and their parents
+    assert sorted(listed) == sorted(map(str, [root, root / 'a', root / 'group', root / 'group' / 'deeper']))
+
+
+def test_discovery_cache_depends_on_prune(tree, tmp_path):
+    root, (a, b, c) = tree
+    cache_path = tmp_path / 'cache.json'
+
+    cache = git_allrepos.DiscoveryCache(cache_path).load()
+    git_allrepos.find_child_repos(root, 2, cache=cache)
+    cache.save()
+
+    cache = git_allrepos.DiscoveryCache(cache_path, prune=['group']).load()
+    assert cache.dirs == {}
+    assert git_allrepos.find_child_repos(root, 2, cache=cache) == [a]
+
+
+def git(cwd, *args):
+    subprocess.run(
+        ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+         '-c', 'protocol.file.allow=always', *args],
+        cwd=cwd, check=True, capture_output=True,
+    )
+
+
+def test_discover_kinds(tmp_path):
+    root = tmp_path / 'src'
+    root.mkdir()
+    main = root / 'main'
+    main.mkdir()
+    git(main, 'init', '-q', '-b', 'main')
+    git(main, 'commit', '-q', '--allow-empty', '-m', 'initial')
+    git(root, 'clone', '-q', '--bare', str(main), 'bare.git')
+    git(main, 'worktree', 'add', '-q', '-b', 'topic', str(root / 'topic'))
+    git(root, 'clone', '-q', str(main), 'super')
+    git(root / 'super', 'submodule', 'add', '-q', str(root / 'bare.git'), 'lib/dep')
+
+    cache = git_allrepos.DiscoveryCache(tmp_path / 'cache.json')
+    for _ in range(2):
+        repos = {
+            repo.path.name: repo
+            for repo in git_allrepos.find_repos(root, 0, cache=cache, submodules=True)
+        }
+        assert {name: repo.kind for name, repo in repos.items()} == {
+            'bare.git': 'bare',
+            'dep': 'submodule',
+            'main': 'repo',
+            'super': 'repo',
+            'topic': 'worktree',
+        }
+        assert repos['topic'].common_dir == repos['main'].common_dir == main / '.git'
+        assert repos['bare.git'].worktree is None
+        assert repos['bare.git'].common_dir == root / 'bare.git'
+        assert repos['dep'].common_dir == root / 'super' / '.git' / 'modules' / 'lib' / 'dep'
@@ -0,0 +1,235 @@
+import io
+import json
+import os
+import subprocess
+import time
+from pathlib import Path
+
+import pytest
+
+from dotfiles.scripts import git_modified
+
+
+def git(repo, *args):
+    subprocess.run(
+        ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com', *args],
+        cwd=repo, check=True, capture_output=True,
+    )
+
+
+def make_repo(path, branch='main'):
+    path.mkdir(parents=True)
+    git(path, 'init', '-q', '-b', branch)
+    (path / 'README').write_text(path.name)
+    git(path, 'add', 'README')
+    git(path, 'commit', '-q', '-m', 'initial')
+    return path
+
+
+@pytest.fixture
+def repos(tmp_path):
+    return [make_repo(tmp_path / f'repo{i}') for i in range(5)]
+
+
+def test_collect_statuses_keeps_order(repos):
+    (repos[2] / 'README').write_text('changed')
+
+    statuses = list(git_modified.collect_statuses(reversed(repos), jobs=3))
+    reports = [git_modified.PorcelainV2Parser().loads(s.stdout, s.repo) for s in statuses]
+
+    assert [r.repo for r in reports] == list(reversed(repos))
+    assert [r.branch for r in reports] == ['main'] * 5
+    assert [r.uncommitted_changes for r in reports] == [False, False, True, False, False]
+
+
+def test_status_timeout(tmp_path, monkeypatch):
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    (bin_dir / 'git').write_text('#!/bin/sh\nexec sleep 10\n')
+    (bin_dir / 'git').chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    started = time.monotonic()
+    status = git_modified.run_status(tmp_path, timeout=0.2)
+
+    assert status.timed_out
+    assert time.monotonic() - started < 5
+
+
+def cached_repos(cache, repos):
+    statuses = git_modified.collect_statuses(repos, jobs=2, cache=cache)
+    parser = git_modified.PorcelainV2Parser()
+    cached = []
+    for status in statuses:
+        if status.report is not None:
+            cached.append(status.repo)
+        else:
+            cache.store(status.repo, status.cache_key, parser.loads(status.stdout, status.repo))
+    return cached
+
+
+def test_status_cache(repos, tmp_path):
+    cache_path = tmp_path / 'cache' / 'git-modified.json'
+
+    # Files modified in the same second as the index keep git status
+    # rewriting it, which would defeat the cache
+    for repo in repos:
+        past = time.time() - 10
+        os.utime(repo / 'README', (past, past))
+        git(repo, 'update-index', '-q', '--refresh')
+
+    cache = git_modified.StatusCache(cache_path).load()
+    assert cached_repos(cache, repos) == []
+    cache.save()
+
+    (repos[1] / 'README').write_text('changed')
+    git(repos[1], 'add', 'README')
+    git(repos[3], 'checkout', '-q', '-b', 'topic')
+
+    cache = git_modified.StatusCache(cache_path).load()
+    assert cached_repos(cache, repos) == [repos[0], repos[2], repos[4]]
+
+    report = cache.lookup(repos[3])[0]
+    assert report.branch == 'topic'
+    assert report.repo == repos[3]
+
+
+def test_status_cache_with_upstream(tmp_path):
+    cache_path = tmp_path / 'cache' / 'git-modified.json'
+    origin = make_repo(tmp_path / 'origin')
+    git(tmp_path, 'clone', '-q', str(origin), 'clone')
+    clone = tmp_path / 'clone'
+    git(tmp_path, 'clone', '-q', str(origin), 'local')
+    local = tmp_path / 'local'
+    git(local, 'checkout', '-q', '--track', '-b', 'topic', 'main')
+    repos = [clone, local]
+
+    for repo in repos:
+        past = time.time() - 10
+        os.utime(repo / 'README', (past, past))
+        git(repo, 'update-index', '-q', '--refresh')
+
+    def run():
+        cache = git_modified.StatusCache(cache_path).load()
+        cached = cached_repos(cache, repos)
+        cache.save()
+        return cached
+
+    assert run() == []
+    assert run() == repos
+
+    # topic tracks the local main, whose ref is under refs/heads/: moving it
+    # (here, just its mtime) invalidates the entry
+    os.utime(local / '.git' / 'refs' / 'heads' / 'main', (past - 10, past - 10))
+    assert run() == [clone]
+
+
+def report(name, **kwargs):
+    fields = dict(branch='main', upstream='origin/main', ahead=0, behind=0, gone=False,
+                  uncommitted_changes=False)
+    return git_modified.BranchReport(repo=Path('/src') / name, **{**fields, **kwargs})
+
+
+def test_table_output_sorts_errors():
+    out = io.StringIO()
+    table = git_modified.TableOutput(out)
+    table.error(Path('/src/b'), 'TIMEOUT')
+    table.add(report('c'))
+    table.error(Path('/src/a'), 'UNKNOWN', "''")
+    table.close()
+
+    assert out.getvalue().splitlines()[:2] == ["UNKNOWN /src/a ''", 'TIMEOUT /src/b']
+
+
+def test_stream_output_widens_columns():
+    out = io.StringIO()
+    stream = git_modified.StreamOutput([Path('/src/a'), Path('/src/longer-name')], out)
+    stream.add(report('a'))
+    stream.add(report('longer-name', branch='feature/wide', upstream=None))
+    stream.close()
+
+    assert out.getvalue().splitlines() == [
+        'NAME         BRANCH  STATUS',
+        'a            main ↙origin',
+        'longer-name  feature/wide',
+    ]
+
+
+def test_live_output_redraws_sorted():
+    out = io.StringIO()
+    live = git_modified.LiveOutput(out)
+    live.add(report('a'))
+    live.add(report('b', behind=2))
+    live.close()
+
+    *_, previous, last = out.getvalue().split('\033[J')
+    assert previous.endswith('\033[3F')
+    assert [line.split()[0] for line in last.splitlines()] == ['NAME', 'b', 'a']
+
+
+def test_ndjson_output():
+    out = io.StringIO()
+    ndjson = git_modified.NdjsonOutput(out)
+    ndjson.add(report('a', ahead=1))
+    ndjson.error(Path('/src/b'), 'TIMEOUT')
+
+    first, second = map(json.loads, out.getvalue().splitlines())
+    assert first['repo'] == '/src/a'
+    assert first['ahead'] == 1
+    assert first['score'] == 100
+    assert second == {'repo': '/src/b', 'error': 'timeout'}
+
+
+def test_fast_status_matches_git_status(tmp_path):
+    origin = make_repo(tmp_path / 'origin')
+    git(tmp_path, 'clone', '-q', str(origin), 'clone')
+    clone = tmp_path / 'clone'
+
+    git(origin, 'commit', '-q', '--allow-empty', '-m', 'remote')
+    git(origin, 'branch', 'old')
+    git(clone, 'fetch', '-q')
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'local 1')
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'local 2')
+    git(clone, 'branch', '-q', '--track', 'gone', 'origin/old')
+    git(clone, 'branch', '-q', '-r', '-d', 'origin/old')
+    git(clone, 'worktree', 'add', '-q', str(tmp_path / 'gone'), 'gone')
+    git(clone, 'worktree', 'add', '-q', '--detach', str(tmp_path / 'detached'), 'HEAD')
+
+    parser = git_modified.PorcelainV2Parser()
+    for repo in (clone, tmp_path / 'gone', tmp_path / 'detached', origin):
+        expected = parser.loads(git_modified.run_status(repo).stdout, repo)
+        assert git_modified.fast_status(repo).report == expected, repo
+
+    report = git_modified.fast_status(clone).report
+    assert (report.ahead, report.behind) == (2, 1)
+
+
+def test_sync_status_reports_every_branch(tmp_path):
+    origin = make_repo(tmp_path / 'origin')
+    git(origin, 'branch', 'feature')
+    git(origin, 'branch', 'old')
+    git(tmp_path, 'clone', '-q', str(origin), 'clone')
+    clone = tmp_path / 'clone'
+
+    git(clone, 'branch', '-q', '--track', 'feature', 'origin/feature')
+    git(clone, 'branch', '-q', '--track', 'old', 'origin/old')
+    git(clone, 'branch', '-q', 'local')
+    git(origin, 'commit', '-q', '--allow-empty', '-m', 'remote')
+    git(origin, 'branch', '-q', '-D', 'old')
+    git(clone, 'fetch', '-q', '--prune')
+    git(clone, 'checkout', '-q', 'feature')
+    git(clone, 'commit', '-q', '--allow-empty', '-m', 'local')
+
+    report = git_modified.sync_status(clone).report
+
+    assert report.branch == 'feature'
+    assert (report.ahead, report.behind) == (1, 0)
+    assert report.branches == [
+        git_modified.BranchSync('feature', 'origin/feature', 1, 0, False),
+        git_modified.BranchSync('local', None, 0, 0, False),
+        git_modified.BranchSync('main', 'origin/main', 0, 1, False),
+        git_modified.BranchSync('old', 'origin/old', 0, 0, True),
+    ]
+    assert [b.name for b in report.other_branches_out_of_sync()] == ['main', 'old']
+    assert report.score() == 200
+    assert git_modified.BranchReport.from_dict(json.loads(json.dumps(report.to_dict()))) == report
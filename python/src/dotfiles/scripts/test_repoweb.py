@@ -0,0 +1,185 @@
+import io
+import os
+import subprocess
+import sys
+from argparse import Namespace
+
+import pytest
+
+from dotfiles.scripts import repoweb
+
+
+def run_git(repo, *args):
+    return subprocess.run(
+        ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+        cwd=repo, check=True, capture_output=True, text=True,
+    ).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    run_git(tmp_path, 'init', '-q', '-b', 'main')
+    run_git(tmp_path, 'commit', '-q', '--allow-empty', '-m', 'initial')
+    run_git(tmp_path, 'remote', 'add', 'origin', 'git@gitlab.com:group/project.git')
+    return tmp_path
+
+
+class CountingQueries(repoweb.GitQueries):
+    def __init__(self, cwd=None):
+        super().__init__(cwd)
+        self.calls = []
+
+    def run(self, args):
+        self.calls.append(args[0])
+        return super().run(args)
+
+
+def test_git_queries_run_once(repo):
+    queries = CountingQueries(repo)
+    head = run_git(repo, 'rev-parse', 'HEAD')
+
+    assert queries.remote_url('origin') == 'git@gitlab.com:group/project.git'
+    assert queries.current_branch == 'main'
+    assert queries.commit('HEAD') == head
+    assert queries.current_branch == 'main'
+    assert queries.resolve('main', 'HEAD', 'main') == [head, head, head]
+    assert queries.remote_url('origin') == 'git@gitlab.com:group/project.git'
+
+    assert queries.calls == ['config', 'rev-parse', 'rev-parse']
+
+
+def test_git_queries_first_url(repo):
+    run_git(repo, 'config', '--add', 'remote.origin.url', 'git@github.com:mirror/project.git')
+    queries = repoweb.GitQueries(repo)
+
+    assert queries.remote_url('origin') == 'git@gitlab.com:group/project.git'
+    assert queries.remote_url('origin') == run_git(repo, 'remote', 'get-url', 'origin')
+
+
+def test_git_queries_url_rewrites(repo):
+    run_git(repo, 'config', 'url.https://gitlab.com/.insteadOf', 'git@gitlab.com:')
+    queries = CountingQueries(repo)
+
+    assert queries.remote_url('origin') == 'https://gitlab.com/group/project.git'
+    assert queries.calls == ['config', 'remote']
+
+
+def test_git_queries_no_remotes(tmp_path):
+    run_git(tmp_path, 'init', '-q')
+    queries = repoweb.GitQueries(tmp_path)
+
+    assert queries.config == {}
+    with pytest.raises(subprocess.CalledProcessError):
+        queries.remote_url('origin')
+
+
+class FakeQueries:
+    current_branch = 'feature'
+
+    def commit(self, ref):
+        return {'feature': 'f00d', 'v1.0': 'beef'}[ref]
+
+
+@pytest.mark.parametrize('command,args,expected', [
+    (repoweb.Commands.view_tree, {'ref': None}, 'https://gitlab.com/group/project/-/tree/feature'),
+    (repoweb.Commands.view_commit, {'ref': 'v1.0'}, 'https://gitlab.com/group/project/-/commit/beef'),
+    (repoweb.Commands.create_merge_request, {'source_branch': None, 'target_branch': 'main'},
+     'https://gitlab.com/group/project/-/merge_requests/new'
+     '?merge_request%5Bsource_branch%5D=feature&merge_request%5Btarget_branch%5D=main'),
+])
+def test_commands_use_injected_queries(command, args, expected):
+    remote = repoweb.resolve_remote_repository('git@gitlab.com:group/project.git')
+    context = repoweb.Context(args=Namespace(command=command, **args), remote=remote,
+                              queries=FakeQueries())
+
+    assert context.resolve_command_handler().get_url(context) == expected
+
+
+# Startup budget for the modules of this package, in microseconds of
+# `python -X importtime` self time (best of a few runs, to smooth out noise).
+# Wall-clock limits depend on the machine, so the check only runs on request.
+STARTUP_BUDGET_US = 25_000
+
+
+def import_times(module):
+    """Self time, in microseconds, of each module imported by `module` in a fresh interpreter."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        check=True, capture_output=True, text=True, env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)},
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, _, name = line.removeprefix('import time:').split('|')
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def test_startup_is_lazy():
+    modules = import_times('dotfiles.scripts.repoweb')
+
+    assert 'configparser' not in modules
+    assert 'concurrent.futures' not in modules
+    assert not [name for name in modules if name.startswith('dotfiles.scripts.repoweb_platforms')]
+
+
+@pytest.mark.skipif(not os.environ.get('DOTFILES_BENCHMARKS'),
+                    reason='timing benchmark; set DOTFILES_BENCHMARKS=1 to run')
+def test_startup_budget():
+    runs = [import_times('dotfiles.scripts.repoweb') for _ in range(5)]
+    own = min(sum(us for name, us in times.items() if name.startswith('dotfiles')) for times in runs)
+
+    assert own <= STARTUP_BUDGET_US, f'importing repoweb took {own} us, over the {STARTUP_BUDGET_US} us budget'
+
+
+def test_parser_builds_only_requested_command():
+    def commands(argv):
+        parser = repoweb.CliParserBuilder().build(argv)
+        return list(parser._subparsers._group_actions[0].choices)
+
+    assert commands(['-r', 'upstream', 'mr', '-t', 'main']) == ['pr', 'mr', 'pull', 'merge']
+    assert commands(['-pr', 'tree', 'commit']) == ['commit']
+    assert commands(['--remote=tree', 'commit']) == ['commit']
+    assert commands(['--rem', 'origin', 'commit']) == ['commit']
+    assert 'tree' in commands(['-j', 'many', 'commit'])
+    assert 'tree' in commands(['-h', 'commit'])
+    assert 'tree' in commands(['nope'])
+
+    args = repoweb.CliParserBuilder().build(['-p', 'prs', '--merged']).parse_args(['-p', 'prs', '--merged'])
+    assert args.command is repoweb.Commands.view_merge_requests
+    assert args.state is repoweb.MergeRequestState.Merged
+
+
+def test_batch(tmp_path, capsys):
+    repos = []
+    for name, url in [('a', 'git@gitlab.com:group/a.git'), ('b', 'https://github.com/user/b.git')]:
+        path = tmp_path / name
+        path.mkdir()
+        run_git(path, 'init', '-q', '-b', 'main')
+        run_git(path, 'commit', '-q', '--allow-empty', '-m', 'initial')
+        run_git(path, 'tag', 'v1')
+        run_git(path, 'remote', 'add', 'origin', url)
+        repos.append(path)
+    a, b = repos
+    commit = run_git(b, 'rev-parse', 'v1')
+    (tmp_path / 'plain').mkdir()
+
+    args = Namespace(command=repoweb.Commands.view_commit, ref=None, remote='origin',
+                     print_only=True, null_separator=False, jobs=4)
+    stdin = io.StringIO(f'{a}\n{tmp_path / "plain"}\n{b}\tv1\n')
+
+    assert repoweb.batch_handler(args, stdin) == 1
+    out, err = capsys.readouterr()
+    assert out.splitlines() == [
+        f'https://gitlab.com/group/a/-/commit/{run_git(a, "rev-parse", "HEAD")}',
+        '',
+        f'https://github.com/user/b/commit/{commit}',
+    ]
+    assert 'plain: fatal: not a git repository' in err
+
+
+def test_read_batch():
+    entries = repoweb.read_batch(io.StringIO('one\0two\tmain\0'), '\0')
+
+    assert entries == [repoweb.BatchEntry('one'), repoweb.BatchEntry('two', 'main')]